@@ -1,28 +1,807 @@
-"""Auto Forward Messages"""
+"""Auto Forward Messages
+
+Importing this module has no side effects: the command line is parsed by
+main() and Pyrogram is imported by import_pyrogram() when a client is
+first needed. Library users that build their own client call
+import_pyrogram() first.
+"""
 from argparse import ArgumentParser, BooleanOptionalAction
-from pyrogram.errors import MessageIdInvalid, FloodWait, UsernameNotOccupied, PeerIdInvalid, ChannelInvalid
-from pyrogram.types import ChatPrivileges
 from configparser import ConfigParser
-from pyrogram.enums import ParseMode
-from pyrogram import Client
+import asyncio
+import copy
+import hashlib
+import math
+import mimetypes
+import shutil
+import sqlite3
+import tempfile
 import time
 import json
 import os
 import re
+import sys
 import logging
 from pathlib import Path
+from itertools import zip_longest, accumulate, repeat
+from bisect import bisect_left, bisect_right
+from array import array
+from collections import OrderedDict
 
-# Configure logging - Fix the format string by correcting levelname syntax
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def import_pyrogram():
+    """Import Pyrogram into the module globals on first use
+
+    Pyrogram loads its whole raw API at import, which is most of the
+    startup time, so it is only imported once something talks to Telegram.
+    """
+    global MessageIdInvalid, FloodWait, UsernameNotOccupied, PeerIdInvalid, ChannelInvalid, ChatForwardsRestricted
+    global ChatPrivileges, ParseMode, MessagesFilter, MessageEntityType, MessageHandler, Client, filters, raw
+    global get_chunk
+    if "Client" in globals():
+        return
+    from pyrogram.errors import (
+        MessageIdInvalid, FloodWait, UsernameNotOccupied, PeerIdInvalid, ChannelInvalid, ChatForwardsRestricted
+    )
+    from pyrogram.types import ChatPrivileges, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+    from pyrogram.enums import ParseMode, MessagesFilter, MessageEntityType
+    from pyrogram.handlers import MessageHandler
+    from pyrogram import Client, filters, raw
+    from pyrogram.methods.messages.get_chat_history import get_chunk
+    ALBUM_MEDIA.update(
+        photo=InputMediaPhoto, video=InputMediaVideo, document=InputMediaDocument, audio=InputMediaAudio
+    )
+
+# Telegram accepts up to 100 message IDs per forward request
+MAX_FORWARD_BATCH = 100
+# History is fetched in pages of this size, one rate-limited request each
+HISTORY_PAGE = 100
+# Max units (single messages or albums) buffered between a job's scanner and its forwarder
+QUEUE_SIZE = 10 * MAX_FORWARD_BATCH
+# Album items arrive as separate updates; live mode waits this long for the rest
+ALBUM_WAIT = 1.0
+# ID ranges smaller than this are scanned by a single iterator
+SHARD_MIN_MESSAGES = 10 * HISTORY_PAGE
+# Chunks fetched and rewritten ahead of the sender in copy mode
+REWRITE_AHEAD = 4
+# Re-uploading media from chats that restrict forwarding
+SPOOL_DIR = "spool"
+MB = 1024 * 1024
+DOWNLOAD_CHUNK = MB  # stream_media always returns 1 MiB chunks
+DOWNLOAD_PARTS = 4  # ranges of a file downloaded at the same time
+REUPLOAD_AHEAD = 2  # units downloaded ahead of the uploads
+# Media kind -> InputMedia class for send_media_group, filled by import_pyrogram
+ALBUM_MEDIA = {}
+
+# --filter types Telegram can select on the server through search_messages;
+# any other type (text, sticker, poll...) falls back to a local history scan.
+# Values are MessagesFilter member names.
+SEARCH_FILTERS = {
+    "photo": "PHOTO",
+    "video": "VIDEO",
+    "document": "DOCUMENT",
+    "audio": "AUDIO",
+    "voice": "VOICE_NOTE",
+    "video_note": "VIDEO_NOTE",
+    "animation": "ANIMATION",
+    "url": "URL",
+    "contact": "CONTACT",
+}
+
+# Adaptive pacing (requests per second): additive increase on success,
+# multiplicative decrease on FloodWait, learned rates persisted per account/mode
+RATE_LIMITS_FILE = 'rate_limits.json'
+MIN_RATE = 1 / 120
+MAX_RATE = 2.0
+RATE_STEP = 0.005
+RATE_BACKOFF = 0.5
+
+# Request latency buckets in seconds, plus the implicit +Inf
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_INTERVAL = 10.0
+
+class Metrics:
+    """Request latency histograms, message counters and queue gauges
+
+    Served as Prometheus text on --metrics-port and/or written as a JSON
+    snapshot to --metrics-file every METRICS_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        # method -> [bucket counts..., +Inf count], sum
+        self.latency = {}
+        self.latency_sum = {}
+        self.counters = {}
+        # (name, job) -> callable returning the current value
+        self.gauges = {}
+
+    def observe(self, method, seconds):
+        counts = self.latency.setdefault(method, [0] * (len(LATENCY_BUCKETS) + 1))
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        self.latency_sum[method] = self.latency_sum.get(method, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        return {
+            "time": time.time(),
+            "requests": {
+                method: {
+                    "count": counts[-1],
+                    "seconds": self.latency_sum[method],
+                    "average": self.latency_sum[method] / counts[-1] if counts[-1] else 0.0,
+                    "buckets": dict(zip(map(str, LATENCY_BUCKETS + ("+Inf",)), counts)),
+                }
+                for method, counts in self.latency.items()
+            },
+            "counters": dict(self.counters),
+            "queue_depth": {job: read() for (name, job), read in self.gauges.items() if name == "queue_depth"},
+        }
+
+    def prometheus(self):
+        """Render the metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP afm_request_seconds Telegram API request latency, excluding rate limiter waits",
+            "# TYPE afm_request_seconds histogram",
+        ]
+        for method, counts in self.latency.items():
+            label = prometheus_label(method)
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                lines.append(f'afm_request_seconds_bucket{{method="{label}",le="{bound}"}} {count}')
+            lines.append(f'afm_request_seconds_sum{{method="{label}"}} {self.latency_sum[method]}')
+            lines.append(f'afm_request_seconds_count{{method="{label}"}} {counts[-1]}')
+        lines += ["# HELP afm_messages_total Messages by outcome", "# TYPE afm_messages_total counter"]
+        for name, value in self.counters.items():
+            if name.startswith("messages_"):
+                lines.append(f'afm_messages_total{{status="{prometheus_label(name[9:])}"}} {value}')
+        lines += [
+            "# HELP afm_flood_wait_seconds_total Seconds of FloodWait imposed by Telegram",
+            "# TYPE afm_flood_wait_seconds_total counter",
+            f"afm_flood_wait_seconds_total {self.counters.get('flood_wait_seconds', 0)}",
+            "# HELP afm_queue_depth Units scanned and waiting to be forwarded",
+            "# TYPE afm_queue_depth gauge",
+        ]
+        for (name, job), read in self.gauges.items():
+            if name == "queue_depth":
+                lines.append(f'afm_queue_depth{{job="{prometheus_label(job)}"}} {read()}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(f"{path}.tmp", "w") as j:
+            json.dump(self.snapshot(), j)
+        os.replace(f"{path}.tmp", path)
+
+    async def write_every(self, path, interval=METRICS_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            self.write(path)
+
+    async def serve(self, port):
+        """Answer every HTTP request on the port with the Prometheus text"""
+        async def respond(reader, writer):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = self.prometheus().encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                             + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+        server = await asyncio.start_server(respond, port=port)
+        logger.info(f"Serving metrics on http://localhost:{port}/metrics")
+        return server
+
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def named(name, method):
+    """Label a lambda for the latency metrics"""
+    method.__name__ = name
+    return method
+
+class RateLimiter:
+    """Token bucket shared by every API call, paced by FloodWait feedback"""
+
+    def __init__(self, key, rate):
+        self.key = key
+        self.rate = max(MIN_RATE, min(rate, MAX_RATE))
+        self.lock = asyncio.Lock()
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.started = self.updated
+        self.last_wait = 0.0
+        self.messages = 0
+
+    @classmethod
+    def load(cls, key, default_rate):
+        """Create a limiter starting at the rate learned in a previous run"""
+        rate = default_rate
+        if os.path.exists(RATE_LIMITS_FILE):
+            try:
+                with open(RATE_LIMITS_FILE, "r") as j:
+                    rate = json.load(j).get(key, default_rate)
+                logger.info(f"Starting at learned rate of {rate*60:.1f} requests/minute for {key}")
+            except (ValueError, OSError) as e:
+                logger.warning(f"Could not read {RATE_LIMITS_FILE}: {e}")
+        return cls(key, rate)
+
+    def save(self):
+        """Persist the current rate for this account and mode"""
+        rates = {}
+        if os.path.exists(RATE_LIMITS_FILE):
+            try:
+                with open(RATE_LIMITS_FILE, "r") as j:
+                    rates = json.load(j)
+            except (ValueError, OSError):
+                pass
+        rates[self.key] = self.rate
+        with open(RATE_LIMITS_FILE, "w") as j:
+            json.dump(rates, j)
+
+    async def acquire(self):
+        """Wait until a request may be sent and return the time waited
+
+        Concurrent callers queue on the lock, so every job shares one budget.
+        """
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = 0.0
+            if self.tokens < 1.0:
+                wait = (1.0 - self.tokens) / self.rate
+                await asyncio.sleep(wait)
+                self.tokens = 1.0
+                self.updated = time.monotonic()
+            self.tokens -= 1.0
+            self.last_wait = wait
+            return wait
+
+    def success(self):
+        self.rate = min(MAX_RATE, self.rate + RATE_STEP)
+
+    def flood_wait(self, seconds):
+        """Back off after a FloodWait and keep the bucket empty until it ends"""
+        metrics.count("flood_wait_seconds", seconds)
+        self.rate = max(MIN_RATE, self.rate * RATE_BACKOFF)
+        self.tokens = 0.0
+        self.updated = time.monotonic() + seconds
+        self.save()
+
+    def ready_in(self):
+        """Seconds until the next request may be sent, including any FloodWait cooldown"""
+        tokens = min(1.0, self.tokens + (time.monotonic() - self.updated) * self.rate)
+        return max(0.0, (1.0 - tokens) / self.rate)
+
+    def messages_per_minute(self):
+        elapsed = time.monotonic() - self.started
+        return self.messages / elapsed * 60 if elapsed > 0 else 0.0
+
+async def call_api(method, *args, **kwargs):
+    """Await a client method through the shared rate limiter, retrying on FloodWait"""
+    return await call_with(limiter, method, *args, **kwargs)
+
+async def call_with(rate_limiter, method, *args, **kwargs):
+    """Await a client method through the given rate limiter, retrying on FloodWait"""
+    while True:
+        wait = await rate_limiter.acquire()
+        name = getattr(method, '__name__', 'request')
+        logger.debug(f"{name}: waited {wait:.2f}s")
+        started = time.monotonic()
+        try:
+            result = await method(*args, **kwargs)
+        except FloodWait as e:
+            rate_limiter.flood_wait(e.value)
+            logger.warning(f"Hit Telegram rate limit. Waiting {e.value} seconds, "
+                           f"slowing down to {rate_limiter.rate*60:.1f} requests/minute")
+            await asyncio.sleep(e.value)
+            continue
+        finally:
+            metrics.observe(name, time.monotonic() - started)
+        rate_limiter.success()
+        return result
+
+class PoolMember:
+    """A started client and the rate limiter that paces it"""
+
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+        # Chats this client has resolved and may forward between
+        self.chats = set()
+
+    @property
+    def name(self):
+        return self.client.name
+
+class ClientPool:
+    """Clients that share the forwarding work, each with its own rate limiter
+
+    The first member is the client that scans the origins. Every forward
+    request goes to the member that can send soonest, so a FloodWait on one
+    account only takes that account out of rotation until its cooldown ends
+    and the pool's throughput grows with the number of accounts. Only
+    channels and supergroups are shared: in basic groups and private chats
+    message IDs are per account, so the scanning client forwards them alone.
+    """
+
+    def __init__(self, members):
+        self.members = members
+        self.started = time.monotonic()
+
+    def bot_ids(self):
+        return [member.client.me.id for member in self.members
+                if getattr(getattr(member.client, "me", None), "is_bot", False)]
+
+    def shared(self, job):
+        # Channels and supergroups are the -100... IDs
+        return str(job.from_chat_id).startswith("-100")
+
+    async def prepare(self, job):
+        """Have every member resolve the job's chats, leaving out those without access"""
+        chats = (job.from_chat_id, job.to_chat_id)
+        self.members[0].chats.update(chats)
+        if len(self.members) > 1 and not self.shared(job):
+            logger.info(f"{job.orig} is not a channel or supergroup, only {self.members[0].name} forwards from it")
+            return
+        for member in self.members[1:]:
+            if member.chats.issuperset(chats):
+                continue
+            try:
+                for chat_id in chats:
+                    await call_with(member.limiter, member.client.get_chat, chat_id)
+                    member.chats.add(chat_id)
+            except Exception as e:
+                logger.warning(f"{member.name} cannot forward {job.orig} -> {job.to_chat_id}: {e}")
+
+    def pick(self, job):
+        if not self.shared(job):
+            return self.members[0]
+        members = [member for member in self.members
+                   if member.chats.issuperset((job.from_chat_id, job.to_chat_id))]
+        return min(members or self.members[:1], key=lambda member: member.limiter.ready_in())
+
+    async def call(self, job, method, *args, **kwargs):
+        """Await method(client, ...) for a job with the member that has the most budget left
+
+        A FloodWait puts the member on cooldown and the request moves on to
+        the next member. Returns the result and the member that sent it.
+        """
+        while True:
+            member = self.pick(job)
+            await member.limiter.acquire()
+            started = time.monotonic()
+            try:
+                result = await method(member.client, *args, **kwargs)
+            except FloodWait as e:
+                member.limiter.flood_wait(e.value)
+                logger.warning(f"{member.name} hit a {e.value} second rate limit, "
+                               f"slowing it down to {member.limiter.rate*60:.1f} requests/minute")
+                continue
+            finally:
+                metrics.observe(method.__name__, time.monotonic() - started)
+            member.limiter.success()
+            return result, member
+
+    def messages_per_minute(self):
+        elapsed = time.monotonic() - self.started
+        messages = sum(member.limiter.messages for member in self.members)
+        return messages / elapsed * 60 if elapsed > 0 else 0.0
+
+    def save(self):
+        for member in self.members:
+            member.limiter.save()
+
+async def open_pool(client):
+    """Start the sessions listed in pool_sessions next to the scanning client
+
+    Sessions already started (by an earlier cycle or by logging in) are reused.
+    """
+    members = [PoolMember(client, limiter)]
+    for name in configs.get("pool_sessions", []):
+        if name == client.name:
+            continue
+        try:
+            extra = await ensure_connection(name)
+        except Exception as e:
+            logger.warning(f"Leaving {name} out of the pool: {e}")
+            continue
+        extra.set_parse_mode(ParseMode.DISABLED)
+        kind = "bot" if extra.me.is_bot else "user"
+        members.append(PoolMember(extra, RateLimiter.load(
+            f"{extra.me.id}:{kind}", 1 / configs.get(f"{kind}_delay_seconds", delay)
+        )))
+    if len(members) > 1:
+        logger.info(f"Forwarding through {len(members)} clients: {', '.join(m.name for m in members)}")
+    return ClientPool(members)
+
+async def collect(messages, min_id=0, keep=None):
+    """Drain an async generator of messages (newest first) into a list, stopping at min_id
+
+    With `keep`, only keep(message) is stored instead of the Message object.
+    """
+    result = []
+    async for message in messages:
+        if message.id <= min_id:
+            await messages.aclose()
+            break
+        result.append(keep(message) if keep else message)
+    return result
+
+async def iter_chat_history(client, chat_id, min_id=0, max_id=None):
+    """Yield the chat history newest first down to min_id, one rate-limited page at a time
+
+    With min_id set to the checkpoint the walk stops at the first page that
+    reaches it, so a resumed scan costs pages for new messages only. With
+    max_id the walk starts at that message instead of the newest one.
+    """
+    offset_id = max_id + 1 if max_id else 0
+    while True:
+        page = await call_api(named("get_chat_history", lambda: collect(client.get_chat_history(chat_id, limit=HISTORY_PAGE, offset_id=offset_id))))
+        if not page:
+            return
+        for message in page:
+            if message.id <= min_id:
+                return
+            yield message
+        offset_id = page[-1].id
+
+async def iter_search(client, chat_id, min_id=0, **kwargs):
+    """Yield search_messages results newest first down to min_id, one rate-limited page at a time
+
+    Pages are requested by offset, so a FloodWait only repeats the current page.
+    """
+    offset = 0
+    while True:
+        page = await call_api(named("search_messages", lambda: collect(client.search_messages(
+            chat_id, offset=offset, limit=HISTORY_PAGE, **kwargs
+        ))))
+        if not page:
+            return
+        for message in page:
+            if message.id <= min_id:
+                return
+            yield message
+        offset += len(page)
+
+async def iter_history_ascending(client, chat_id, min_id=0):
+    """Yield the messages newer than min_id oldest first, one page at a time
+
+    Each page is a single GetHistory request for the messages starting at
+    the cursor (offset_id=cursor+1 with a negative offset), so the history is
+    read in reverse without ever holding more than one page. Pyrogram's
+    get_chat_history is not used here: on a short page it requests again
+    from the oldest message it got, which with a negative offset returns
+    the same window until `limit` messages were yielded.
+    """
+    cursor = min_id
+    while True:
+        page = await call_api(named("get_chat_history", lambda: get_chunk(
+            client=client, chat_id=chat_id, limit=HISTORY_PAGE, offset=-HISTORY_PAGE, from_message_id=cursor + 1
+        )))
+        page = sorted({msg.id: msg for msg in page if msg.id > cursor}.values(), key=lambda msg: msg.id)
+        if not page:
+            return
+        for message in page:
+            yield message
+        cursor = page[-1].id
+
+# Ledger of forwarded/failed messages; rows are committed together at most
+# every LEDGER_COMMIT_SECONDS or LEDGER_COMMIT_ROWS rows
+LEDGER_FILE = 'ledger.db'
+LEDGER_COMMIT_SECONDS = 2.0
+LEDGER_COMMIT_ROWS = 1000
+
+class Ledger:
+    """SQLite (WAL) record of every message forwarded or failed, per chat pair
+
+    Checkpoints are the highest forwarded ID of each pair. Checkpoints left by
+    older versions in posteds/{from}_{to}.json are imported on open.
+    """
+
+    def __init__(self, path=LEDGER_FILE):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                from_chat_id INTEGER NOT NULL,
+                to_chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                dest_message_id INTEGER,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (from_chat_id, to_chat_id, message_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                from_chat_id INTEGER NOT NULL,
+                to_chat_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                PRIMARY KEY (from_chat_id, to_chat_id)
+            );
+        """)
+        self.pending = 0
+        self.committed = time.monotonic()
+        self.import_posteds()
+
+    def import_posteds(self):
+        """Seed checkpoints from the single-integer JSON cache files"""
+        for path in Path('posteds').glob('*_*.json'):
+            try:
+                from_chat_id, to_chat_id = (int(part) for part in path.stem.rsplit('_', 1))
+                with open(path, "r") as j:
+                    last_id = int(json.load(j))
+            except (ValueError, TypeError, OSError) as e:
+                logger.warning(f"Skipping cache file {path}: {e}")
+                continue
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO checkpoints VALUES (?, ?, ?)", (from_chat_id, to_chat_id, last_id)
+            )
+            if cursor.rowcount:
+                logger.info(f"Imported checkpoint {last_id} from {path}")
+        self.db.commit()
+
+    def last_id(self, from_chat_id, to_chat_id):
+        row = self.db.execute(
+            "SELECT last_id FROM checkpoints WHERE from_chat_id = ? AND to_chat_id = ?",
+            (from_chat_id, to_chat_id)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def failed_ids(self, from_chat_id, to_chat_id):
+        rows = self.db.execute(
+            "SELECT message_id FROM messages WHERE from_chat_id = ? AND to_chat_id = ? AND status = 'failed' "
+            "ORDER BY message_id",
+            (from_chat_id, to_chat_id)
+        )
+        return [row[0] for row in rows]
+
+    def record(self, from_chat_id, to_chat_id, message_ids, status, dest_ids=()):
+        """Upsert the outcome of one attempt for each message ID"""
+        now = time.time()
+        rows = [
+            (from_chat_id, to_chat_id, message_id, status, dest_id, now)
+            for message_id, dest_id in zip_longest(message_ids, dest_ids[:len(message_ids)])
+        ]
+        self.db.executemany("""
+            INSERT INTO messages VALUES (?, ?, ?, ?, 1, ?, ?)
+            ON CONFLICT (from_chat_id, to_chat_id, message_id) DO UPDATE SET
+                status = excluded.status,
+                attempts = attempts + 1,
+                dest_message_id = COALESCE(excluded.dest_message_id, dest_message_id),
+                updated_at = excluded.updated_at
+        """, rows)
+        metrics.count(f"messages_{status}", len(rows))
+        # Duplicates are recorded while queued, ahead of units not sent yet,
+        # so only a forward moves the checkpoint
+        if status == "forwarded":
+            self.db.execute("""
+                INSERT INTO checkpoints VALUES (?, ?, ?)
+                ON CONFLICT (from_chat_id, to_chat_id) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)
+            """, (from_chat_id, to_chat_id, max(message_ids)))
+        self.pending += len(rows)
+        if self.pending >= LEDGER_COMMIT_ROWS or time.monotonic() - self.committed >= LEDGER_COMMIT_SECONDS:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+        self.committed = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+# Fingerprints kept in memory in front of the ledger's fingerprints table
+DEDUP_CACHE_SIZE = 100000
+
+def fingerprint(message):
+    """Content key of a message: its media's file_unique_id, else a hash of its normalized text"""
+    media = getattr(message, message.media.value, None) if message.media else None
+    if getattr(media, "file_unique_id", None):
+        return f"media:{media.file_unique_id}"
+    text = " ".join((message.text or message.caption or "").lower().split())
+    if not text:
+        return None
+    return "text:" + hashlib.sha1(text.encode()).hexdigest()
+
+def fingerprint_key(key):
+    """64-bit form of a content key: the first 8 bytes of its SHA-1, as a signed int"""
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big", signed=True)
+
+def unit_fingerprint(fingerprints):
+    """Combine the fingerprints of a unit's messages into its 64-bit key; None if any item has none"""
+    if not fingerprints or None in fingerprints:
+        return None
+    if len(fingerprints) == 1:
+        return fingerprint_key(fingerprints[0])
+    return fingerprint_key("album:" + hashlib.sha1("|".join(sorted(fingerprints)).encode()).hexdigest())
+
+class DedupIndex:
+    """Content fingerprints already sent to each destination
+
+    A bounded LRU in memory in front of a table in the ledger database, so
+    duplicates are dropped before they cost an API call, across runs and
+    across origins. Fingerprints are claimed while in flight and stored once
+    the forward succeeds, in the same transaction as the ledger rows.
+    """
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self.ledger.db.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                to_chat_id INTEGER NOT NULL,
+                fingerprint INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                PRIMARY KEY (to_chat_id, fingerprint)
+            ) WITHOUT ROWID
+        """)
+        if self.ledger.db.execute("PRAGMA user_version").fetchone()[0] < 1:
+            # Older versions stored the content keys themselves, see unit_fingerprint
+            self.ledger.db.create_function("fingerprint_key", 1, fingerprint_key, deterministic=True)
+            self.ledger.db.execute(
+                "UPDATE OR IGNORE fingerprints SET fingerprint = fingerprint_key(fingerprint) "
+                "WHERE typeof(fingerprint) = 'text' AND fingerprint LIKE '%:%'"
+            )
+            self.ledger.db.execute("PRAGMA user_version = 1")
+            self.ledger.commit()
+        self.cache = OrderedDict()
+        self.claimed = set()
+
+    def remember(self, key):
+        self.cache[key] = True
+        self.cache.move_to_end(key)
+        if len(self.cache) > DEDUP_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def seen(self, to_chat_id, fingerprint):
+        key = (to_chat_id, fingerprint)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return True
+        row = self.ledger.db.execute(
+            "SELECT 1 FROM fingerprints WHERE to_chat_id = ? AND fingerprint = ?", key
+        ).fetchone()
+        if row:
+            self.remember(key)
+        return row is not None
+
+    def claim(self, to_chat_id, fingerprint):
+        """Reserve a fingerprint for a forward; False if it was sent or is in flight"""
+        key = (to_chat_id, fingerprint)
+        if key in self.claimed or self.seen(to_chat_id, fingerprint):
+            return False
+        self.claimed.add(key)
+        return True
+
+    def confirm(self, to_chat_id, fingerprint, message_id):
+        key = (to_chat_id, fingerprint)
+        self.claimed.discard(key)
+        self.ledger.db.execute("INSERT OR IGNORE INTO fingerprints VALUES (?, ?, ?)", (*key, message_id))
+        self.remember(key)
+
+    def release(self, to_chat_id, fingerprint):
+        self.claimed.discard((to_chat_id, fingerprint))
+
+class Job:
+    """One origin -> destination forwarding task with its own filter and query
+
+    Copy jobs send the messages without the forward header, optionally
+    rewriting their texts with regex replacements, link stripping and a
+    caption template where {text} stands for the rewritten text.
+    """
+
+    def __init__(self, orig, dest=None, filter=None, query="", copy=False, caption=None, replace=(),
+                 strip_links=False):
+        self.orig = orig
+        self.dest = dest
+        self.filter = filter.split(",") if isinstance(filter, str) and filter else filter
+        self.query = query or ""
+        self.copy = bool(copy)
+        self.caption = caption.replace("\\n", "\n") if caption else None
+        self.replacements = parse_replacements(replace)
+        self.strip_links = bool(strip_links)
+        self.from_chat_id = None
+        self.to_chat_id = None
+        self.last_id = 0
+        # Fingerprints of the units in flight, by their first message ID
+        self.fingerprints = {}
+        # Set once the origin refuses forwards, so media is re-uploaded
+        self.protected = False
+
+    @property
+    def label(self):
+        """Names the job in progress lines and metrics; jobs may share an origin"""
+        return f"{self.orig}->{self.to_chat_id}"
+
+    @property
+    def rewrites(self):
+        return bool(self.caption or self.replacements or self.strip_links)
+
+def parse_replacements(items):
+    """(pattern, replacement) pairs from "PATTERN=>REPLACEMENT" strings or pairs"""
+    pairs = []
+    for item in items or ():
+        if isinstance(item, str):
+            pattern, _, replacement = item.partition("=>")
+        else:
+            pattern, replacement = item
+        re.compile(pattern)
+        pairs.append((pattern, replacement))
+    return pairs
+
+def job_from_entry(orig, dest, entry):
+    """Build a Job from the optional keys of a jobs or routes entry"""
+    return Job(orig, dest, entry.get("filter"), entry.get("query", ""),
+               entry.get("copy", options.copy), entry.get("caption", options.caption),
+               entry.get("replace", options.replace), entry.get("strip_links", options.strip_links))
+
+def load_jobs(path):
+    """Read a JSON list of {"orig", "dest", "filter", "query"} jobs
+
+    Jobs may also set "copy", "caption", "replace" and "strip_links";
+    the command line values are used for the keys they leave out.
+    """
+    with open(path, "r") as j:
+        entries = json.load(j)
+    return [job_from_entry(entry["orig"], entry.get("dest"), entry) for entry in entries]
+
+def load_routes(path):
+    """Read a TOML or YAML routing file into jobs, one per origin -> destination route
+
+    Each entry of its "routes" list has an "orig" and a "dest" that is a chat
+    or a list of chats; a chat is a string or a table with a "chat" key and
+    its own job keys. Job keys set on the route are the defaults of its
+    destinations:
+
+        [[routes]]
+        orig = "@source"
+        copy = true
+        dest = ["@mirror", {chat = "@photos", filter = "photo,video"}]
+    """
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError("YAML routing files need PyYAML: pip install pyyaml")
+        with open(path, "r") as f:
+            data = yaml.safe_load(f) or {}
+    else:
+        try:
+            import tomllib
+        except ImportError:
+            raise RuntimeError("TOML routing files need Python 3.11 or newer")
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+    jobs = []
+    for route in data.get("routes", []):
+        dests = route.get("dest")
+        for dest in dests if isinstance(dests, list) else [dests]:
+            entry = dict(route)
+            if isinstance(dest, dict):
+                entry.update(dest)
+                dest = dest.get("chat")
+            jobs.append(job_from_entry(route["orig"], dest, entry))
+    return jobs
+
+# Channels/supergroups (-100...), users/bots/private channels and groups
+CHAT_ID_PATTERN = re.compile(r'^-?\d+$')
+# t.me and telegram.me links (public or joinchat) or a bare @username
+CHAT_LINK_PATTERN = re.compile(r'(?:t|telegram)\.me/(?:joinchat/)?([^/?]+)|@?([a-zA-Z]\w{3,30}[a-zA-Z\d])$')
+
 def is_chat_id(chat):
     if chat is None:
         return False
-    # Support more formats: -100 channels (with any number of digits), regular IDs, and username-like strings
-    return bool(re.match(r'^(-100)\d+$', str(chat)) or  # Channel/supergroup - updated to handle longer IDs
-                re.match(r'^\d+$', str(chat)) or  # User/bot/private channel
-                re.match(r'^-\d+$', str(chat)))  # Group
+    if isinstance(chat, int):
+        return True
+    return CHAT_ID_PATTERN.match(chat if isinstance(chat, str) else str(chat)) is not None
 
 def convert_channel_id(chat_id):
     """Convert channel IDs to the format Pyrogram can understand
@@ -34,7 +813,7 @@ def convert_channel_id(chat_id):
         # and converting the rest to int (this is what Pyrogram expects)
         try:
             raw_id = int(chat_id[4:])
-            logger.info(f"Converting channel ID from {chat_id} to raw format: {raw_id}")
+            logger.debug(f"Converting channel ID from {chat_id} to raw format: {raw_id}")
             return raw_id
         except ValueError:
             logger.error(f"Failed to convert channel ID: {chat_id}")
@@ -45,20 +824,30 @@ def extract_chat_id_from_link(link):
     """Extract channel username or ID from various telegram links"""
     if link is None:
         return None
+    link = str(link)
     
     # Handle t.me links, telegram.me, or direct usernames
-    username_match = re.search(r't\.me/(?:joinchat/)?([^/?]+)|telegram\.me/(?:joinchat/)?([^/?]+)|@?([a-zA-Z]\w{3,30}[a-zA-Z\d])$', link)
+    username_match = CHAT_LINK_PATTERN.search(link)
     if username_match:
-        # Return the first non-None group
-        return next((group for group in username_match.groups() if group is not None), None)
+        return username_match.group(1) or username_match.group(2)
     
     # Try direct ID (already handled by is_chat_id)
     return link if is_chat_id(link) else None
 
-def check_chat_id(client, chat_id):
+def normalize_chat(chat):
+    """What get_chat is asked for a link, @username or ID: an ID or a bare username"""
+    chat_id = extract_chat_id_from_link(chat)
+    if is_chat_id(chat_id):
+        # New format channel IDs (-100...) are converted for Pyrogram
+        if str(chat_id).startswith('-100'):
+            return convert_channel_id(chat_id)
+        return int(chat_id)
+    return (chat_id or chat).lstrip('@')
+
+async def check_chat_id(client, chat_id):
     """Check if a chat ID is valid and accessible"""
     try:
-        chat_obj = client.get_chat(chat_id)
+        chat_obj = await call_api(client.get_chat, chat_id)
         if hasattr(chat_obj, 'title'):
             return chat_obj.title, chat_obj.id
         else:
@@ -80,117 +869,229 @@ def check_chat_id(client, chat_id):
         logger.error(f"Error checking chat: {chat_id}. Error: {e}")
         return None, None
 
-def get_chats(client, bot_id):
-    global from_chat, to_chat, chats
+# Resolved chats (link/username/ID -> peer) are reused for this long
+CHAT_CACHE_FILE = 'chat_cache.json'
+CHAT_CACHE_TTL = 7 * 24 * 3600
+
+class ChatCache:
+    """Persistent map of account -> link/username/ID -> resolved peer (id, access hash, title, type)
+
+    Access hashes are only valid for the account that resolved them, so
+    every account (client.me.id) has its own entries.
+    """
+
+    def __init__(self, path=CHAT_CACHE_FILE):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as j:
+                    entries = json.load(j)
+                # Entries of older versions were not keyed by account and are dropped
+                self.entries = {
+                    account: keys for account, keys in entries.items() if "resolved_at" not in keys
+                }
+            except (ValueError, OSError, AttributeError) as e:
+                logger.warning(f"Could not read {path}: {e}")
+
+    def get(self, account, key):
+        entry = self.entries.get(str(account), {}).get(str(key))
+        if entry and time.time() - entry["resolved_at"] < CHAT_CACHE_TTL:
+            return entry
+        return None
+
+    def put(self, account, key, entry, save=True):
+        self.entries.setdefault(str(account), {})[str(key)] = dict(entry, resolved_at=time.time())
+        if save:
+            self.save()
+
+    def invalidate(self, chat_id):
+        """Forget every key that resolved to chat_id, for every account"""
+        stale = []
+        for keys in self.entries.values():
+            for key in [key for key, entry in keys.items() if entry["id"] == chat_id]:
+                del keys[key]
+                stale.append(key)
+        if stale:
+            logger.info(f"Dropped cached resolution of {', '.join(stale)}")
+            self.save()
+
+    def save(self):
+        with open(self.path, "w") as j:
+            json.dump(self.entries, j)
+
+async def resolve_cached(client, key):
+    """Title and ID of a chat cached by this client's account, seeding its session's peer table so no API call is needed"""
+    entry = chat_cache.get(client.me.id, key) if key else None
+    if entry is None:
+        return None, None
+    try:
+        await client.storage.get_peer_by_id(entry["id"])
+    except KeyError:
+        await client.storage.update_peers([(entry["id"], entry["access_hash"], entry["type"], None, None)])
+    return entry["title"], entry["id"]
+
+async def remember_chat(client, key, title, chat_id, save=True):
+    """Cache a chat resolved through the API; its peer is already in the session"""
+    peer = await client.resolve_peer(chat_id)
+    if isinstance(peer, raw.types.InputPeerChannel):
+        entry = {"id": chat_id, "access_hash": peer.access_hash, "type": "channel"}
+    elif isinstance(peer, raw.types.InputPeerUser):
+        entry = {"id": chat_id, "access_hash": peer.access_hash, "type": "user"}
+    elif isinstance(peer, raw.types.InputPeerChat):
+        entry = {"id": chat_id, "access_hash": 0, "type": "group"}
+    else:
+        return
+    chat_cache.put(client.me.id, key, dict(entry, title=title), save)
+
+async def resolve_chat(client, chat, role):
+    """Title and ID of the origin or destination chat of a job, from the cache or the API"""
+    title, resolved_id = await resolve_cached(client, chat)
+    if resolved_id is not None:
+        logger.info(f"{role.capitalize()} chat resolved from cache: ID={resolved_id}, Title={title}")
+        return title, resolved_id
+    chat_id = extract_chat_id_from_link(chat)
+    logger.info(f"Extracted {role} chat: {chat_id}")
+    try:
+        target = normalize_chat(chat)
+        title, resolved_id = await check_chat_id(client, target)
+        if resolved_id is None:
+            raise ValueError(f"Could not find {role} chat: {chat}")
+        logger.info(f"{role.capitalize()} chat resolved: ID={resolved_id}, Title={title}")
+    except (ValueError, PeerIdInvalid, UsernameNotOccupied) as e:
+        logger.error(f"Error getting {role} chat: {e}")
+        logger.error(f"Additional info - Chat ID format used: {chat_id}")
+        if str(chat_id).startswith('-100'):
+            logger.error(f"This appears to be a channel ID. Tried with format: {convert_channel_id(chat_id)}")
+        raise ValueError(f"Could not find {role} chat: {chat}. Error: {e}")
+    await remember_chat(client, chat, title, resolved_id)
+    return title, resolved_id
+
+# Chats of a links file resolved at the same time
+RESOLVE_WORKERS = 8
+
+def read_links(path):
+    """Unique chats of a links file as {key: (get_chat target, [links])}
+
+    The file has one link, @username or ID per line; blank lines and lines
+    starting with # are skipped. Usernames are compared case-insensitively.
+    """
+    targets = {}
+    with open(path, "r") as f:
+        for line in f:
+            link = line.strip()
+            if not link or link.startswith("#"):
+                continue
+            chat_id = extract_chat_id_from_link(link)
+            # IDs are passed on as they are: Pyrogram reads -100... as a channel
+            target = int(chat_id) if is_chat_id(chat_id) else normalize_chat(link)
+            key = target.lower() if isinstance(target, str) else target
+            links = targets.setdefault(key, (target, []))[1]
+            if link not in links:
+                links.append(link)
+    return targets
+
+async def import_links(client, path, manifest_path):
+    """Resolve every chat of a links file and write a manifest of their IDs for later jobs
+
+    Each unique chat costs at most one get_chat, made RESOLVE_WORKERS at a
+    time through the shared rate limiter, and none if the cache knows it.
+    Every spelling of a link and the resolved ID are cached, so jobs naming
+    them later resolve without the API.
+    """
+    targets = read_links(path)
+    logger.info(f"Resolving {len(targets)} unique chats from {path}")
+    semaphore = asyncio.Semaphore(RESOLVE_WORKERS)
+
+    async def resolve(target, links):
+        async with semaphore:
+            title, chat_id = await resolve_cached(client, links[0])
+            if chat_id is None:
+                title, chat_id = await check_chat_id(client, target)
+                if chat_id is None:
+                    return None
+                await remember_chat(client, links[0], title, chat_id, save=False)
+            entry = chat_cache.get(client.me.id, links[0])
+            if entry:
+                for key in [*links[1:], chat_id]:
+                    chat_cache.put(client.me.id, key, entry, save=False)
+            return {"id": chat_id, "title": title, "type": entry and entry["type"], "links": links}
+
+    results = await asyncio.gather(*(resolve(target, links) for target, links in targets.values()))
+    chat_cache.save()
+    resolved = [result for result in results if result]
+    failed = [link for result, (_, links) in zip(results, targets.values()) if not result for link in links]
+    tmp = f"{manifest_path}.tmp"
+    with open(tmp, "w") as j:
+        json.dump({"resolved": resolved, "failed": failed}, j, indent=1, ensure_ascii=False)
+    os.replace(tmp, manifest_path)
+    logger.info(f"Resolved {len(resolved)} chats, {len(failed)} links failed; manifest written to {manifest_path}")
+
+async def get_chats(client, job, bot_id):
+    from_chat, to_chat = job.orig, job.dest
     logger.info(f"Trying to resolve chats - From: {from_chat}, To: {to_chat}")
     
     try:
-        # Try to extract username or ID if it's a link
-        from_chat_id = extract_chat_id_from_link(from_chat)
-        logger.info(f"Extracted from_chat_id: {from_chat_id}")
-        
-        # Try to get chat info
-        from_chat_title, from_chat_resolved_id = None, None
-        try:
-            if is_chat_id(from_chat_id):
-                # If it's a new format channel ID (-100...), convert it properly
-                if str(from_chat_id).startswith('-100'):
-                    chat_id_to_use = convert_channel_id(from_chat_id)
-                    logger.info(f"Using converted channel ID: {chat_id_to_use}")
-                    from_chat_title, from_chat_resolved_id = check_chat_id(client, chat_id_to_use)
-                else:
-                    from_chat_title, from_chat_resolved_id = check_chat_id(client, int(from_chat_id))
-                logger.info(f"Found chat by ID: {from_chat_resolved_id}")
-            else:
-                # Handle username (remove @ if present)
-                username = from_chat_id.lstrip('@') if from_chat_id else from_chat.lstrip('@')
-                from_chat_title, from_chat_resolved_id = check_chat_id(client, username)
-                logger.info(f"Found chat by username: {from_chat_resolved_id}")
-                
-            if from_chat_resolved_id is None:
-                raise ValueError(f"Could not find origin chat: {from_chat}")
-                
-            chats["from_chat_id"] = from_chat_resolved_id
-            logger.info(f"Origin chat resolved: ID={from_chat_resolved_id}, Title={from_chat_title}")
-        except (ValueError, PeerIdInvalid, UsernameNotOccupied) as e:
-            logger.error(f"Error getting origin chat: {e}")
-            logger.error(f"Additional info - Chat ID format used: {from_chat_id}")
-            if str(from_chat_id).startswith('-100'):
-                logger.error(f"This appears to be a channel ID. Tried with format: {convert_channel_id(from_chat_id)}")
-            raise ValueError(f"Could not find origin chat: {from_chat}. Error: {e}")
+        from_chat_title, job.from_chat_id = await resolve_chat(client, from_chat, "origin")
         
         # Handle destination chat
         if to_chat:
-            to_chat_id = extract_chat_id_from_link(to_chat)
-            logger.info(f"Extracted to_chat_id: {to_chat_id}")
-            
-            try:
-                to_chat_title, to_chat_resolved_id = None, None
-                if is_chat_id(to_chat_id):
-                    # If it's a new format channel ID (-100...), convert it properly
-                    if str(to_chat_id).startswith('-100'):
-                        chat_id_to_use = convert_channel_id(to_chat_id)
-                        logger.info(f"Using converted channel ID: {chat_id_to_use}")
-                        to_chat_title, to_chat_resolved_id = check_chat_id(client, chat_id_to_use)
-                    else:
-                        to_chat_title, to_chat_resolved_id = check_chat_id(client, int(to_chat_id))
-                    logger.info(f"Found destination chat by ID: {to_chat_resolved_id}")
-                else:
-                    # Handle username (remove @ if present)
-                    username = to_chat_id.lstrip('@') if to_chat_id else to_chat.lstrip('@')
-                    to_chat_title, to_chat_resolved_id = check_chat_id(client, username)
-                    logger.info(f"Found destination chat by username: {to_chat_resolved_id}")
-                
-                if to_chat_resolved_id is None:
-                    raise ValueError(f"Could not find destination chat: {to_chat}")
-                    
-                chats["to_chat_id"] = to_chat_resolved_id
-                logger.info(f"Destination chat resolved: ID={to_chat_resolved_id}")
-            except (ValueError, PeerIdInvalid, UsernameNotOccupied) as e:
-                logger.error(f"Error getting destination chat: {e}")
-                logger.error(f"Additional info - Chat ID format used: {to_chat_id}")
-                if str(to_chat_id).startswith('-100'):
-                    logger.error(f"This appears to be a channel ID. Tried with format: {convert_channel_id(to_chat_id)}")
-                raise ValueError(f"Could not find destination chat: {to_chat}. Error: {e}")
+            _, job.to_chat_id = await resolve_chat(client, to_chat, "destination")
         else:
             # Create destination channel if none provided
             logger.info(f"Creating new destination channel named '{from_chat_title}-clone'")
-            dest = client.create_channel(title=f'{from_chat_title}-clone')
-            chats["to_chat_id"] = dest.id
-            logger.info(f"Created destination channel with ID: {chats['to_chat_id']}")
+            dest = await call_api(client.create_channel, title=f'{from_chat_title}-clone')
+            job.to_chat_id = dest.id
+            logger.info(f"Created destination channel with ID: {job.to_chat_id}")
         
-        # Bot mode permissions
-        if mode == "bot" and bot_id not in ('bot_id:none', ''):
-            bot_numeric_id = int(bot_id.replace('bot_id:', ''))
+        # Bot permissions, for the configured bot in bot mode and every bot in the pool
+        bot_ids = set(pool.bot_ids()) if pool else set()
+        if mode == "bot" and parse_bot_id(bot_id):
+            bot_ids.add(parse_bot_id(bot_id))
+        for bot_numeric_id in sorted(bot_ids):
             logger.info(f"Setting bot permissions for bot_id: {bot_numeric_id}")
-            for chat_id in [chats["from_chat_id"], chats["to_chat_id"]]:
+            for chat_id in [job.from_chat_id, job.to_chat_id]:
                 try:
-                    client.promote_chat_member(
+                    await call_api(
+                        client.promote_chat_member,
                         privileges=ChatPrivileges(can_post_messages=True),
                         chat_id=chat_id,
                         user_id=bot_numeric_id
                     )
-                    logger.info(f"Bot promoted in chat {chat_id}")
+                    logger.info(f"Bot {bot_numeric_id} promoted in chat {chat_id}")
                 except Exception as e:
-                    logger.warning(f"Could not promote bot in chat {chat_id}: {e}")
+                    logger.warning(f"Could not promote bot {bot_numeric_id} in chat {chat_id}: {e}")
                     
-    except FloodWait as e:
-        logger.warning(f"Hit Telegram rate limit. Waiting {e.value} seconds...")
-        time.sleep(e.value)
-        get_chats(client, bot_id)  # Retry after waiting
     except Exception as e:
         logger.error(f"Unexpected error in get_chats: {e}", exc_info=True)
         raise
 
-def ensure_connection(client_name, api_id=None, api_hash=None, bot_token=None):
-    """Ensure valid connection to Telegram API, creating or reusing session files"""
+def parse_bot_id(value):
+    """Numeric bot ID from a config value such as 'bot_id:123', or None"""
+    value = str(value or "").replace("bot_id:", "").strip()
+    return int(value) if value.isdigit() else None
+
+async def ensure_connection(client_name, api_id=None, api_hash=None, bot_token=None):
+    """Ensure valid connection to Telegram API, creating or reusing session files
+
+    A client started earlier in this process is returned as is, so logging
+    in, scanning, forwarding and every restart cycle share one connection.
+    """
+    if client_name in clients:
+        return clients[client_name]
+    import_pyrogram()
     logger.info(f"Ensuring connection for {client_name}...")
-    
-    if client_name == "user":
+    client = await start_client(client_name, api_id, api_hash, bot_token)
+    clients[client_name] = client
+    return client
+
+async def start_client(client_name, api_id=None, api_hash=None, bot_token=None):
+    """Start a session from its session file, or log in with the given credentials"""
+    if not client_name.startswith("bot"):
         if Path(f"{client_name}.session").exists():
             try:
                 client = Client(client_name)
-                client.start()
+                await client.start()
                 logger.info(f"Connected using existing session: {client_name}")
                 return client
             except Exception as e:
@@ -200,18 +1101,18 @@ def ensure_connection(client_name, api_id=None, api_hash=None, bot_token=None):
         if api_id and api_hash:
             try:
                 client = Client(client_name, api_id=api_id, api_hash=api_hash)
-                client.start()
+                await client.start()
                 logger.info(f"Connected as user with provided API credentials")
                 return client
             except Exception as e:
                 logger.error(f"Error connecting with provided credentials: {e}")
                 raise
     
-    elif client_name == "bot":
+    else:
         if Path(f"{client_name}.session").exists() and not (api_id and api_hash and bot_token):
             try:
                 client = Client(client_name)
-                client.start()
+                await client.start()
                 logger.info(f"Connected using existing bot session")
                 return client
             except Exception as e:
@@ -221,7 +1122,7 @@ def ensure_connection(client_name, api_id=None, api_hash=None, bot_token=None):
         if api_id and api_hash and bot_token:
             try:
                 client = Client(client_name, api_id=api_id, api_hash=api_hash, bot_token=bot_token)
-                client.start()
+                await client.start()
                 logger.info(f"Connected as bot with provided credentials")
                 return client
             except Exception as e:
@@ -231,35 +1132,55 @@ def ensure_connection(client_name, api_id=None, api_hash=None, bot_token=None):
     logger.error(f"Failed to establish connection for {client_name}")
     raise ValueError(f"Could not establish connection for {client_name}")
 
-def connect_to_api(api_id, api_hash, bot_token):
+async def stop_clients():
+    """Stop every client started by ensure_connection"""
+    while clients:
+        name, client = clients.popitem()
+        try:
+            await client.stop()
+        except Exception as e:
+            logger.warning(f"Error stopping {name}: {e}")
+
+async def connect_to_api(api_id, api_hash, bot_token, session='user'):
+    """Log in the user session and any bots, and write config.ini
+
+    bot_token may hold several comma separated tokens: the first one is the
+    'bot' session used in bot mode and the others become pool sessions
+    bot2, bot3... A user session other than 'user' is added to the pool too.
+    Each client is started once and kept running for the jobs that follow.
+    """
     try:
-        logger.info("Connecting to Telegram API as user...")
-        client = Client('user', api_id=api_id, api_hash=api_hash)
-        bot_id = 'bot_id:none'
-        
-        with client:
-            user_id = client.get_me().id
-            logger.info(f"Connected as user: {user_id}")
-            client.send_message(
-                user_id, "Message sent with **Auto Forward Messages**!"
-            )
+        # Keep the pool and bot of a previous setup when adding accounts
+        previous = ConfigParser()
+        previous.read('config.ini')
+        previous = dict(previous["default"]) if "default" in previous else {}
+        pool_sessions = [name for name in previous.get("pool_sessions", "").split(",") if name]
+        bot_id = f'bot_id:{previous["bot_id"]}' if parse_bot_id(previous.get("bot_id")) else 'bot_id:none'
+
+        logger.info(f"Connecting to Telegram API as user ({session})...")
+        client = await ensure_connection(session, api_id, api_hash)
+        logger.info(f"Connected as user: {client.me.id}")
+        if session != 'user':
+            pool_sessions.append(session)
         
-        if bot_token:
-            logger.info("Connecting to Telegram API as bot...")
-            bot_client = Client(
-                'bot', api_id=api_id, api_hash=api_hash, bot_token=bot_token
-            )
-            
-            with bot_client:
-                bot_id_num = bot_token.split(':')[0]
+        tokens = [token.strip() for token in (bot_token or "").split(",") if token.strip()]
+        for number, token in enumerate(tokens, 1):
+            name = 'bot' if number == 1 else f'bot{number}'
+            logger.info(f"Connecting to Telegram API as bot ({name})...")
+            await ensure_connection(name, api_id, api_hash, token)
+            bot_id_num = token.split(':')[0]
+            logger.info(f"Connected as bot: bot_id:{bot_id_num}")
+            if number == 1:
                 bot_id = f'bot_id:{bot_id_num}'
-                bot_client.send_message(
-                    user_id, "Message sent with **Auto Forward Messages**!"
-                )
-                logger.info(f"Connected as bot: {bot_id}")
+            else:
+                pool_sessions.append(name)
+        pool_sessions = list(dict.fromkeys(pool_sessions))
         
         # Create default configuration
-        data = f"[default]\n{bot_id}\nuser_delay_seconds:10\nbot_delay_seconds:5\nskip_delay_seconds:1"
+        data = (f"[default]\n{bot_id}\nuser_delay_seconds:10\nbot_delay_seconds:5\nskip_delay_seconds:1"
+                f"\npool_sessions:{','.join(pool_sessions)}")
+        if previous.get("routes"):
+            data += f"\nroutes:{previous['routes']}"
         with open('config.ini', 'w') as f:
             f.write(data)
         
@@ -268,6 +1189,8 @@ def connect_to_api(api_id, api_hash, bot_token):
         configs["user_delay_seconds"] = 10.0
         configs["bot_delay_seconds"] = 5.0
         configs["skip_delay_seconds"] = 1.0
+        configs["pool_sessions"] = pool_sessions
+        configs["routes"] = previous.get("routes")
         
         return client, bot_id
     except Exception as e:
@@ -279,134 +1202,1007 @@ def is_empty_message(message) -> bool:
         return True
     return False
 
-def filter_messages(client):
-    list_ids=[]
+def matches_filter(message, filter) -> bool:
+    """Check a message against the --filter types"""
+    if not filter:
+        return True
+    if message.media:
+        msg_media=str(message.media)
+        msg_type=msg_media.replace('MessageMediaType.','')
+        if msg_type.lower() in filter:
+            return True
+    if message.text and "text" in filter:
+        return True
+    if message.poll and "poll" in filter:
+        return True
+    if "url" in filter and any(
+        entity.type in (MessageEntityType.URL, MessageEntityType.TEXT_LINK)
+        for entity in (message.entities or message.caption_entities or [])
+    ):
+        return True
+    return False
+
+def search_filters(filter):
+    """Server-side search filters for the --filter types, or None if any needs a local scan"""
+    if filter and all(msg_type in SEARCH_FILTERS for msg_type in filter):
+        return [getattr(MessagesFilter, SEARCH_FILTERS[msg_type]) for msg_type in filter]
+    return None
+
+def matches_query(message, query) -> bool:
+    """Local equivalent of search_messages for the streaming scan"""
+    if query == "":
+        return True
+    text = message.text or message.caption or ""
+    file_name = getattr(getattr(message, "document", None), "file_name", None) or ""
+    return query.lower() in text.lower() or query.lower() in file_name.lower()
+
+class UnitIds:
+    """Forward units held as compact arrays of message IDs, oldest first
+
+    All IDs live in one array of 64-bit ints and each unit ends at an offset
+    in `ends`, so a selection costs about 16 bytes per message plus 8 per
+    unit for its fingerprint, never the Message objects. Fingerprints are
+    only kept with --dedup, and a unit without one is stored as 0. Units are
+    iterated as (unit, fingerprint) pairs like a list of them.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.ends = array("q")
+        self.fingerprints = array("q") if options.dedup else None
+
+    def append(self, unit, digest):
+        self.ids.extend(unit)
+        self.ends.append(len(self.ids))
+        if self.fingerprints is not None:
+            self.fingerprints.append(digest or 0)
+
+    def reverse(self):
+        """Turn units appended newest first, with descending IDs, into oldest first"""
+        lengths = array("q", (end - start for start, end in zip([0] + self.ends[:-1].tolist(), self.ends)))
+        lengths.reverse()
+        self.ids.reverse()
+        self.ends = array("q", accumulate(lengths))
+        if self.fingerprints is not None:
+            self.fingerprints.reverse()
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __iter__(self):
+        start = 0
+        for end, digest in zip(self.ends, self.fingerprints if self.fingerprints is not None else repeat(0)):
+            yield self.ids[start:end].tolist(), digest or None
+            start = end
+
+    def message_count(self):
+        return len(self.ids)
+
+    def units(self, first, last):
+        """The units first..last-1 as a new UnitIds"""
+        part = UnitIds()
+        start = self.ends[first - 1] if first else 0
+        end = self.ends[last - 1] if last else 0
+        part.ids = self.ids[start:end]
+        part.ends = array("q", (offset - start for offset in self.ends[first:last]))
+        part.fingerprints = self.fingerprints[first:last] if self.fingerprints is not None else None
+        return part
+
+    def after(self, last_id):
+        """Units with any message newer than last_id, found by binary search"""
+        return self.units(bisect_right(self.ends, bisect_right(self.ids, last_id)), len(self))
+
+    def before(self, first_id):
+        """Units with every message older than first_id, found by binary search"""
+        return self.units(0, bisect_right(self.ends, bisect_left(self.ids, first_id)))
+
+    def extend(self, other):
+        """Append the units of a UnitIds that is entirely newer than this one"""
+        offset = len(self.ids)
+        self.ids.extend(other.ids)
+        self.ends.extend(end + offset for end in other.ends)
+        if self.fingerprints is not None:
+            self.fingerprints.extend(other.fingerprints)
+
+    def limit(self, count):
+        """The first units holding `count` messages, without cutting the last one"""
+        return self.units(0, min(len(self), bisect_right(self.ends, count - 1) + 1))
+
+def summarize(message, selected=True):
+    """What a scan keeps of a message: (id, media_group_id, fingerprint, selected)"""
+    return message.id, message.media_group_id, fingerprint(message), selected
+
+def group_units(records):
+    """Group (id, media_group_id, fingerprint, selected) records into UnitIds
+
+    An album becomes a unit as soon as any of its items is selected, so
+    albums are never split by the filter.
+    """
+    units = {}
+    fingerprints = {}
+    chosen = set()
+    for message_id, group_id, digest, selected in records:
+        key = group_id or message_id
+        units.setdefault(key, []).append(message_id)
+        fingerprints.setdefault(key, []).append(digest)
+        if selected:
+            chosen.add(key)
+    grouped = UnitIds()
+    for unit, digest in sorted(
+        ((sorted(units[key]), unit_fingerprint(fingerprints[key])) for key in chosen),
+        key=lambda pair: pair[0][0]
+    ):
+        grouped.append(unit, digest)
+    return grouped
+
+async def scan_units(messages, selectors, boundary=None):
+    """Group a newest-first history into one UnitIds per selector as it arrives, keeping no Message objects
+
+    Album items have consecutive IDs, so an album is complete as soon as a
+    message from outside it arrives; it is kept whole by every selector that
+    selects any of its items. With a boundary the scan stops at the first
+    message at or below it that does not continue the current album.
+    Returns the selections and the lowest message ID read.
+    """
+    selections = [UnitIds() for _ in selectors]
+    unit, fingerprints, group_id, matched = [], [], None, [False] * len(selectors)
+    lowest = None
+
+    def close_unit():
+        digest = unit_fingerprint(fingerprints)
+        for units, unit_matched in zip(selections, matched):
+            if unit_matched:
+                units.append(unit, digest)
+
+    async for message in messages:
+        if boundary is not None and message.id <= boundary and not (
+            group_id and message.media_group_id == group_id
+        ):
+            await messages.aclose()
+            break
+        lowest = message.id
+        if is_empty_message(message):
+            continue
+        if unit and not (group_id and message.media_group_id == group_id):
+            if any(matched):
+                close_unit()
+            unit, fingerprints, matched = [], [], [False] * len(selectors)
+        unit.append(message.id)
+        fingerprints.append(fingerprint(message))
+        group_id = message.media_group_id
+        matched = [unit_matched or selected(message) for unit_matched, selected in zip(matched, selectors)]
+    if unit and any(matched):
+        close_unit()
+    for units in selections:
+        units.reverse()
+    return selections, lowest
+
+async def scan_history(client, chat_id, min_id, selectors):
+    """One UnitIds per selector for the history above min_id, sharded when the chat is big enough"""
+    selections = await scan_sharded(client, chat_id, min_id, selectors)
+    if selections is None:
+        selections, _ = await scan_units(iter_chat_history(client, chat_id, min_id), selectors)
+    return selections
+
+async def scan_sharded(client, chat_id, min_id, selectors):
+    """Scan the history above min_id as ID-range shards read concurrently, merged in order
+
+    The ID space up to the newest message is cut into 2 * --scan-shards
+    ranges, at most --scan-shards of which are read at a time; every page
+    still goes through the shared rate limiter. A shard finishes the album
+    it is reading past its lower bound, and the shard below drops what was
+    already read. Returns None when the ID range above min_id is too small
+    to be worth it, as after a resume with few new messages.
+    """
+    if options.scan_shards <= 1:
+        return None
+    newest = await call_api(named("get_chat_history", lambda: collect(client.get_chat_history(chat_id, limit=1))))
+    if not newest or newest[0].id <= min_id:
+        return [UnitIds() for _ in selectors]
+    top = newest[0].id
+    if top - min_id < SHARD_MIN_MESSAGES:
+        return None
+    pieces = options.scan_shards * 2
+    width = math.ceil((top - min_id) / pieces)
+    bounds = [(max(min_id, top - (i + 1) * width), top - i * width) for i in range(pieces)]
+    bounds = [(low, high) for low, high in bounds if high > min_id]
+    logger.info(f"Scanning messages {min_id + 1}-{top} as {len(bounds)} shards, {options.scan_shards} at a time")
+    semaphore = asyncio.Semaphore(options.scan_shards)
+
+    async def scan(low, high):
+        async with semaphore:
+            if low == min_id:
+                return await scan_units(iter_chat_history(client, chat_id, min_id, high), selectors)
+            return await scan_units(iter_chat_history(client, chat_id, 0, high), selectors, low)
+
+    shards = await asyncio.gather(*(scan(low, high) for low, high in bounds))
+    selections = [UnitIds() for _ in selectors]
+    lowest = None
+    # Newest shard first, so each one knows where the shard above stopped
+    trimmed = []
+    for shard, shard_lowest in shards:
+        trimmed.append([units.before(lowest) for units in shard] if lowest is not None else shard)
+        if shard_lowest is not None:
+            lowest = shard_lowest if lowest is None else min(lowest, shard_lowest)
+    for shard in reversed(trimmed):
+        for merged, units in zip(selections, shard):
+            merged.extend(units)
+    return selections
+
+async def complete_albums(client, job, records):
+    """Add the missing items of albums found by a search, one get_media_group call per album"""
+    complete = []
+    seen_groups = set()
+    for record in records:
+        message_id, group_id = record[0], record[1]
+        if group_id is None:
+            complete.append(record)
+        elif group_id not in seen_groups:
+            seen_groups.add(group_id)
+            complete.extend(map(summarize, await call_api(client.get_media_group, job.from_chat_id, message_id)))
+    return complete
+
+async def filter_messages(client, job, min_id=0):
+    """Collect the units (albums or single messages) that match and are newer than min_id
+
+    Only message IDs and fingerprints are kept, see UnitIds.
+    """
+    units=UnitIds()
     print("Getting messages...\n")
     try:
-        if query == "":
-            messages=client.get_chat_history(chats["from_chat_id"])
-            messages=[msg for msg in messages if not is_empty_message(msg)]
-        else:
-            messages=client.search_messages(
-                chats["from_chat_id"], query=query
-            )
-        
-        if filter:
-            for message in messages:
-                if message.media:
-                    msg_media=str(message.media)
-                    msg_type=msg_media.replace('MessageMediaType.','')
-                    if msg_type.lower() in filter:
-                        list_ids.append(message.id)
-                if message.text and "text" in filter:
-                    list_ids.append(message.id)
-                if message.poll and "poll" in filter:
-                    list_ids.append(message.id)
-        else:
-            list_ids=[message.id for message in messages]
+        server_filters = search_filters(job.filter)
+        if server_filters:
+            # Telegram selects the types (and the query) itself, one search per type
+            records=[]
+            for search_filter in server_filters:
+                records.extend(await collect(iter_search(
+                    client, job.from_chat_id, min_id, query=job.query, filter=search_filter
+                ), keep=summarize))
+            records=await complete_albums(client, job, records)
+            # Every search hit matches; album siblings ride along with them
+            return group_units({record[0]: record for record in records}.values())
+        if job.query == "":
+            [units] = await scan_history(client, job.from_chat_id, min_id, [lambda msg: matches_filter(msg, job.filter)])
+            return units
+        records=await collect(iter_search(
+            client, job.from_chat_id, min_id, query=job.query
+        ), keep=lambda msg: summarize(msg, matches_filter(msg, job.filter)))
+        records=await complete_albums(client, job, [record for record in records if record[3]])
+        units=group_units(records)
     except Exception as e:
         logger.error(f"Error filtering messages: {e}", exc_info=True)
         raise
 
-    return list_ids
+    return units
 
-def get_ids(client):
-    global CACHE_FILE
-    
+async def stream_ids(client, job, resume):
+    """Yield matching units oldest first while the history is being scanned
+
+    Pages are filtered as they arrive and pushed into the job's bounded queue,
+    so at most one page of messages is alive regardless of chat size. Album
+    items have consecutive IDs and are gathered into one unit, kept whole if
+    any of them matches.
+    """
+    last_id = open_checkpoint(job)
+    if not resume:
+        last_id = 0
+    elif last_id:
+        logger.info(f"Resuming stream after message ID {last_id}")
+    print("Streaming messages...\n")
+    count = 0
+    unit, fingerprints, group_id, matched = [], [], None, False
+    async for msg in iter_history_ascending(client, job.from_chat_id, last_id):
+        if is_empty_message(msg):
+            continue
+        if unit and (msg.media_group_id is None or msg.media_group_id != group_id):
+            if matched:
+                yield unit, unit_fingerprint(fingerprints)
+                count += len(unit)
+                if limit != 0 and count >= limit:
+                    return
+            unit, fingerprints, matched = [], [], False
+        unit.append(msg.id)
+        fingerprints.append(fingerprint(msg))
+        group_id = msg.media_group_id
+        matched = matched or (matches_query(msg, job.query) and matches_filter(msg, job.filter))
+    if unit and matched:
+        yield unit, unit_fingerprint(fingerprints)
+
+async def iter_ids(units):
+    """Async view of an already collected list of (unit, fingerprint) pairs"""
+    for pair in units:
+        yield pair
+
+def open_checkpoint(job):
+    """Load the job's last forwarded ID from the ledger"""
+    job.last_id = ledger.last_id(job.from_chat_id, job.to_chat_id)
+    return job.last_id
+
+async def count_messages(client, job):
+    """Size of the selection: server-side search counts when they apply, else the history size"""
+    server_filters = search_filters(job.filter)
+    if not server_filters:
+        return await call_api(client.get_chat_history_count, job.from_chat_id)
+    total = 0
+    for search_filter in server_filters:
+        total += await call_api(
+            client.search_messages_count, job.from_chat_id, query=job.query, filter=search_filter
+        )
+    logger.info(f"Telegram reports {total} messages matching {','.join(job.filter)}")
+    return total
+
+async def get_ids(client, job, resume):
     try:
-        total = client.get_chat_history_count(chats["from_chat_id"])
-        if total > 25000:
-            print(
-                "Warning: The origin chat contains a large number of messages.\n"+
-                "It is recommended to forward up to 1000 messages per day.\n"
-            )
-        chat_ids = filter_messages(client)
-        chat_ids.sort()
-        
-        # Ensure the posteds directory exists
-        os.makedirs('posteds', exist_ok=True)
-        
-        # Create a unique cache file name based on both chat IDs
-        cache = f'{chats["from_chat_id"]}_{chats["to_chat_id"]}.json'
-        CACHE_FILE = f'posteds/{cache}'
-
-        # Handle resuming from previous point
-        if options.resume and os.path.exists(CACHE_FILE):
-            with open(CACHE_FILE, "r") as j:
-                last_id = json.load(j)
-            # Find the index of the last processed message
-            last_ids = [i for i in chat_ids if i <= last_id]
-            if last_ids:
-                last_id = last_ids[-1]
-                n = chat_ids.index(last_id) + 1
-                chat_ids = chat_ids[n:]
-                logger.info(f"Resuming from message ID {last_id} (index {n})")
-            else:
-                logger.info("No previous messages found in the current set to resume from")
+        last_id = open_checkpoint(job)
 
-        # Apply message limit if specified
-        if limit != 0:
-            chat_ids = chat_ids[:limit]
-            logger.info(f"Limited to {limit} messages")
-            
-        logger.info(f"Found {len(chat_ids)} messages to forward")
-        return chat_ids
+        # Handle resuming from previous point: the checkpoint bounds the scan
+        if resume and last_id:
+            logger.info(f"Resuming after message ID {last_id}, scanning newer messages only")
+        else:
+            last_id = 0
+            warn_large_chat(await count_messages(client, job))
+        # Album items fetched by a search may reach below the checkpoint
+        return trim_units(job, await filter_messages(client, job, last_id), last_id)
     except Exception as e:
         logger.error(f"Error getting message IDs: {e}", exc_info=True)
         raise
 
-def auto_forward(client, chat_ids):
-    """Forward messages from source to destination chat with error handling and progress tracking"""
-    os.makedirs('posteds', exist_ok=True)
-    
-    total = len(chat_ids)
+def warn_large_chat(total):
+    if total > 25000:
+        print(
+            "Warning: The origin chat contains a large number of messages.\n"+
+            "It is recommended to forward up to 1000 messages per day.\n"
+        )
+
+def trim_units(job, units, last_id):
+    """The units above the checkpoint, cut to --limit without splitting an album"""
+    units = units.after(last_id)
+    if limit != 0:
+        units = units.limit(limit)
+        logger.info(f"Limited to {limit} messages")
+    logger.info(f"Found {units.message_count()} messages to forward from {job.orig} to {job.to_chat_id}")
+    return units
+
+async def scan_origin(client, jobs, resume):
+    """Scan an origin once for every job reading it and return each job's units
+
+    All filters and queries are evaluated in the same pass over the history,
+    locally like in --stream, and each job keeps what is above its own
+    checkpoint, so the scan starts at the oldest of them.
+    """
+    last_ids = [open_checkpoint(job) if resume else 0 for job in jobs]
+    origin = jobs[0]
+    if resume and min(last_ids):
+        logger.info(f"Resuming {origin.orig} after message ID {min(last_ids)}, scanning newer messages only")
+    elif not any(last_ids):
+        warn_large_chat(await call_api(client.get_chat_history_count, origin.from_chat_id))
+    logger.info(f"Scanning {origin.orig} once for {len(jobs)} destinations")
+    print("Getting messages...\n")
+    selectors = [
+        lambda msg, job=job: matches_query(msg, job.query) and matches_filter(msg, job.filter) for job in jobs
+    ]
+    selections = await scan_history(client, origin.from_chat_id, min(last_ids), selectors)
+    return {job: trim_units(job, units, last_id) for job, units, last_id in zip(jobs, selections, last_ids)}
+
+async def forward_chunk(client, job, chunk):
+    """Forward a chunk of message IDs with a single request
+
+    On MessageIdInvalid the chunk is split in half and both halves are retried,
+    so only the invalid IDs are dropped. Returns the number of failed IDs.
+    """
+    try:
+        dest_ids, member = await pool.call(job, copy_batch if job.copy else forward_batch, job, chunk)
+    except MessageIdInvalid:
+        if len(chunk) == 1:
+            logger.warning(f"Invalid message ID: {chunk[0]} - skipping")
+            ledger.record(job.from_chat_id, job.to_chat_id, chunk, "failed")
+            release_fingerprints(job, chunk)
+            return 1
+        middle = len(chunk) // 2
+        logger.info(f"Invalid message ID in chunk {chunk[0]}-{chunk[-1]}, splitting it")
+        return await forward_half(client, job, chunk[:middle]) + await forward_half(client, job, chunk[middle:])
+    record_sent(job, chunk, dest_ids, member)
+    logger.info(f"Forwarded {chunk[0]}-{chunk[-1]} via {member.name} after waiting {member.limiter.last_wait:.2f}s "
+                f"({pool.messages_per_minute():.1f} messages/minute)")
+    return 0
+
+async def forward_half(client, job, half):
+    """forward_chunk for half of a split chunk, recording its own errors
+
+    The other half may already be forwarded, so a failure must not be
+    recorded against the whole chunk by the caller.
+    """
+    try:
+        return await forward_chunk(client, job, half)
+    except (PeerIdInvalid, ChannelInvalid, ChatForwardsRestricted):
+        raise
+    except Exception as e:
+        logger.error(f"Error forwarding messages {half[0]}-{half[-1]}: {e}", exc_info=True)
+        ledger.record(job.from_chat_id, job.to_chat_id, half, "failed")
+        release_fingerprints(job, half)
+        return len(half)
+
+async def forward_batch(client, job, chunk):
+    """Forward a chunk with one request and return the destination IDs"""
+    forwarded = await client.forward_messages(
+        from_chat_id=job.from_chat_id,
+        chat_id=job.to_chat_id,
+        message_ids=chunk
+    )
+    return [message.id for message in forwarded] if isinstance(forwarded, list) else []
+
+async def copy_batch(client, job, chunk):
+    """Forward a chunk with one request, dropping the forward header, and return the destination IDs"""
+    sent = await client.invoke(
+        raw.functions.messages.ForwardMessages(
+            to_peer=await client.resolve_peer(job.to_chat_id),
+            from_peer=await client.resolve_peer(job.from_chat_id),
+            id=chunk,
+            random_id=[client.rnd_id() for _ in chunk],
+            drop_author=True
+        )
+    )
+    return [
+        update.message.id for update in getattr(sent, "updates", [])
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage))
+    ]
+
+def record_sent(job, unit, dest_ids, member):
+    """Confirm the fingerprints and ledger rows of messages that reached the destination"""
+    for message_id in unit:
+        digest = job.fingerprints.pop(message_id, None)
+        if digest:
+            dedup.confirm(job.to_chat_id, digest, message_id)
+    ledger.record(job.from_chat_id, job.to_chat_id, unit, "forwarded", dest_ids)
+    job.last_id = max(job.last_id, unit[-1])
+    member.limiter.messages += len(unit)
+
+LINK_PATTERN = re.compile(r"(?:https?://|www\.|(?:t|telegram)\.me/)\S+", re.IGNORECASE)
+
+def rewrite_text(text, template=None, replacements=(), strip_links=False, media=False):
+    """Apply a job's replacements, link stripping and caption template to a text
+
+    The template is not applied to a text message left empty, which is then skipped.
+    """
+    for pattern, replacement in replacements:
+        text = re.sub(pattern, replacement, text)
+    if strip_links:
+        text = LINK_PATTERN.sub("", text)
+        text = "\n".join(line.rstrip() for line in text.split("\n"))
+    if template and (text.strip() or media):
+        text = template.replace("{text}", text)
+    return text.strip()
+
+def utf16_length(text):
+    """Length in UTF-16 code units, the unit of Telegram entity offsets"""
+    return len(text.encode("utf-16-le")) // 2
+
+def kept_entities(job, message):
+    """The message's entities shifted into a copy whose caption template only wraps {text}
+
+    Replacements and link stripping move the text around, so those copies
+    are sent without entities.
+    """
+    text = message.text if message.text is not None else message.caption
+    entities = message.entities if message.text is not None else message.caption_entities
+    if not entities or job.replacements or job.strip_links:
+        return None
+    if not job.caption:
+        return entities
+    if job.caption.count("{text}") != 1:
+        return None
+    prefix, suffix = job.caption.split("{text}")
+    full = prefix + str(text) + suffix
+    # rewrite_text strips the result, which may eat into the prefix
+    lead = len(full) - len(full.lstrip())
+    if lead > len(prefix):
+        return None
+    shift = utf16_length(prefix[lead:])
+    kept = []
+    for entity in entities:
+        entity = copy.copy(entity)
+        entity.offset += shift
+        kept.append(entity)
+    return kept
+
+def rewrite_texts(texts, template, replacements, strip_links):
+    """Rewrite the (text, is media) pairs of a chunk; runs in the worker pool"""
+    return [rewrite_text(text, template, replacements, strip_links, media) for text, media in texts]
+
+def text_workers():
+    """Process pool that keeps the text rewriting off the event loop"""
+    global rewrite_pool
+    if rewrite_pool is None:
+        # Only copy jobs with rewrites pay for importing multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        rewrite_pool = ProcessPoolExecutor(max_workers=options.copy_workers)
+    return rewrite_pool
+
+async def prepare_rewrite(client, job, chunk):
+    """Fetch the messages of a chunk and rewrite their texts in the worker pool
+
+    Errors are returned instead of raised so the sender can record them
+    against the chunk.
+    """
+    try:
+        messages = await call_api(client.get_messages, job.from_chat_id, chunk)
+        texts = await asyncio.get_running_loop().run_in_executor(
+            text_workers(), rewrite_texts,
+            [(str(message.text or message.caption or ""), message.text is None and bool(message.media))
+             for message in messages],
+            job.caption, job.replacements, job.strip_links
+        )
+        return messages, texts
+    except Exception as e:
+        return e
+
+async def schedule_rewrites(client, job, chunks, prepared):
+    """Start preparing each chunk as soon as it is packed; the queue is closed with None"""
+    try:
+        async for chunk in chunks:
+            await prepared.put((chunk, asyncio.ensure_future(prepare_rewrite(client, job, chunk))))
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        await prepared.put(None)
+        raise
+    await prepared.put(None)
+
+async def rewrite_ahead(client, job, chunks):
+    """Yield (chunk, prepared) pairs while up to REWRITE_AHEAD later chunks are being prepared"""
+    prepared = asyncio.Queue(maxsize=REWRITE_AHEAD)
+    scheduler = asyncio.create_task(schedule_rewrites(client, job, chunks, prepared))
+    try:
+        item = await prepared.get()
+        while item is not None:
+            chunk, task = item
+            yield chunk, await task
+            item = await prepared.get()
+    except BaseException:
+        scheduler.cancel()
+        while not prepared.empty():
+            item = prepared.get_nowait()
+            if item:
+                item[1].cancel()
+        raise
+    await scheduler
+
+async def without_rewrites(chunks):
+    async for chunk in chunks:
+        yield chunk, None
+
+def group_prepared(messages, texts):
+    """Split a prepared chunk back into units, keeping album items together"""
+    units = []
+    for message, text in zip(messages, texts):
+        group_id = getattr(message, "media_group_id", None)
+        if units and group_id and units[-1][0][-1].media_group_id == group_id:
+            units[-1][0].append(message)
+            units[-1][1].append(text)
+        else:
+            units.append(([message], [text]))
+    return units
+
+async def copy_rewritten(client, job, chunk, prepared):
+    """Send a prepared chunk one unit at a time with the rewritten texts
+
+    Albums are sent with copy_media_group so they stay grouped, without
+    entities. Formatting and text links are kept when the caption template
+    only wraps {text}, and dropped with --replace or --strip-links. Texts
+    that end up empty are skipped. Returns the number of failed IDs.
+    """
+    if isinstance(prepared, Exception):
+        raise prepared
+    messages, texts = prepared
+    member = pool.pick(job)
+    if member.client is not client:
+        # Media can only be re-sent by the account that fetched it
+        messages = await call_with(member.limiter, member.client.get_messages, job.from_chat_id, chunk)
     failed = 0
-    
-    for index, message_id in enumerate(chat_ids):
+    for unit_messages, unit_texts in group_prepared(messages, texts):
+        unit = [message.id for message in unit_messages]
         try:
-            os.system('clear || cls')
-            current = index + 1
-            print(f"Forwarding: {current}/{total} ({(current/total)*100:.1f}%)")
-            
-            # Forward message
-            client.forward_messages(
-                from_chat_id=chats["from_chat_id"],
-                chat_id=chats["to_chat_id"],
-                message_ids=message_id
-            )
-            
-            # Update cache file with last processed message ID
-            with open(CACHE_FILE, "w") as j:
-                json.dump(message_id, j)
-                
-            # Delay between messages if not the last one
-            if message_id != chat_ids[-1]:
-                time.sleep(delay)
-                
-        except MessageIdInvalid:
-            logger.warning(f"Invalid message ID: {message_id} - skipping")
-            failed += 1
-            
-        except FloodWait as e:
-            logger.warning(f"Hit Telegram rate limit. Waiting {e.value} seconds...")
-            # Save current progress
-            with open(CACHE_FILE, "w") as j:
-                json.dump(message_id, j)
-            time.sleep(e.value)
-            # Try to forward the same message again
-            index -= 1
-            
+            if any(message.empty for message in unit_messages):
+                raise ValueError("message no longer exists")
+            if len(unit_messages) > 1:
+                sent = await call_with(
+                    member.limiter, member.client.copy_media_group,
+                    job.to_chat_id, job.from_chat_id, unit[0], captions=unit_texts
+                )
+            elif unit_messages[0].text is None and unit_messages[0].media:
+                # Message.copy ignores the caption of text messages, link previews included
+                sent = [await call_with(
+                    member.limiter, unit_messages[0].copy, job.to_chat_id, caption=unit_texts[0],
+                    caption_entities=kept_entities(job, unit_messages[0])
+                )]
+            elif unit_texts[0]:
+                sent = [await call_with(
+                    member.limiter, member.client.send_message, job.to_chat_id, unit_texts[0],
+                    entities=kept_entities(job, unit_messages[0]),
+                    disable_web_page_preview=not unit_messages[0].web_page
+                )]
+            else:
+                logger.info(f"Skipping {unit[0]}: its text is empty after rewriting")
+                ledger.record(job.from_chat_id, job.to_chat_id, unit, "skipped")
+                release_fingerprints(job, unit)
+                continue
+        except (PeerIdInvalid, ChannelInvalid):
+            raise
         except Exception as e:
-            logger.error(f"Error forwarding message {message_id}: {e}", exc_info=True)
-            failed += 1
-            # Brief pause before continuing
-            time.sleep(2)
+            logger.warning(f"Could not copy {unit[0]}-{unit[-1]}: {e}")
+            ledger.record(job.from_chat_id, job.to_chat_id, unit, "failed")
+            release_fingerprints(job, unit)
+            failed += len(unit)
+            continue
+        record_sent(job, unit, [message.id for message in sent], member)
+    logger.info(f"Copied {chunk[0]}-{chunk[-1]} via {member.name} "
+                f"({pool.messages_per_minute():.1f} messages/minute)")
+    return failed
+
+def release_fingerprints(job, chunk):
+    """Free the fingerprints of units that could not be forwarded"""
+    for message_id in chunk:
+        digest = job.fingerprints.pop(message_id, None)
+        if digest:
+            dedup.release(job.to_chat_id, digest)
+
+def claim_unit(job, unit, digest):
+    """Check a unit against the destination's duplicate index before it is queued"""
+    if digest is None or not options.dedup:
+        return True
+    if not dedup.claim(job.to_chat_id, digest):
+        logger.info(f"Skipping duplicate content {unit[0]}-{unit[-1]} from {job.orig}")
+        ledger.record(job.from_chat_id, job.to_chat_id, unit, "duplicate")
+        return False
+    job.fingerprints[unit[0]] = digest
+    return True
+
+async def feed_queue(job, units, queue):
+    """Push new units from an async iterable of (unit, fingerprint) into a forward queue
+
+    Duplicates are dropped here at no API cost; the queue is closed with None.
+    """
+    try:
+        async for unit, digest in units:
+            if claim_unit(job, unit, digest):
+                await queue.put(unit)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        await queue.put(None)
+        raise
+    await queue.put(None)
+
+async def iter_chunks(queue, size):
+    """Pack queued units into chunks of up to `size` IDs without splitting one
+
+    Only the first unit of a chunk is waited for, so whatever is already
+    queued goes out right away. An album therefore costs a single request.
+    """
+    unit = await queue.get()
+    while unit is not None:
+        chunk, carried = list(unit), False
+        while not queue.empty():
+            unit = queue.get_nowait()
+            if unit is None or len(chunk) + len(unit) > size:
+                carried = True
+                break
+            chunk.extend(unit)
+        yield chunk
+        if not carried:
+            unit = await queue.get()
+
+class Spool:
+    """Bounded on-disk cache for the media being re-uploaded
+
+    Space is reserved before a download starts and waited for when the
+    spool is full. Uploaded files stay cached, so retries and other
+    destinations reuse them, until their space is needed, oldest first;
+    files still in use are never evicted.
+    """
+
+    def __init__(self, path=SPOOL_DIR, capacity=2048 * MB):
+        Path(path).mkdir(exist_ok=True)
+        # A directory of its own, so nothing else under path is ever deleted
+        self.path = Path(tempfile.mkdtemp(prefix="afm-", dir=path))
+        self.capacity = capacity
+        self.used = 0
+        self.files = OrderedDict()
+        self.pins = {}
+        self.ready = {}
+        self.changed = asyncio.Condition()
+
+    async def reserve(self, files):
+        """Pin a unit's (name, size) files together, waiting for room to download them
+
+        Returns the names that are not cached yet and must be downloaded.
+        Reserving a whole album at once keeps two units from each holding
+        part of the spool while waiting for the rest.
+        """
+        files = dict(files)
+        total = sum(files.values())
+        if total > self.capacity:
+            raise ValueError(f"{total/MB:.1f} MB does not fit in the {self.capacity/MB:.0f} MB spool")
+        async with self.changed:
+            while self.used + sum(size for name, size in files.items() if name not in self.files) > self.capacity:
+                if not self.evict(files):
+                    await self.changed.wait()
+            missing = []
+            waits = []
+            for name, size in files.items():
+                self.pins[name] = self.pins.get(name, 0) + 1
+                if name in self.files:
+                    self.files.move_to_end(name)
+                    waits.append(self.ready[name])
+                else:
+                    self.files[name] = size
+                    self.used += size
+                    self.ready[name] = asyncio.Event()
+                    missing.append(name)
+        # Another job may still be downloading the cached ones
+        for ready in waits:
+            await ready.wait()
+        return missing
+
+    def evict(self, keep=()):
+        """Delete the oldest file not in use; returns False if there is none"""
+        for name in self.files:
+            if name not in self.pins and name not in keep:
+                self.drop(name)
+                return True
+        return False
+
+    def drop(self, name):
+        self.used -= self.files.pop(name)
+        self.ready.pop(name).set()
+        (self.path / name).unlink(missing_ok=True)
+
+    def downloaded(self, name):
+        self.ready[name].set()
+
+    async def release(self, name, failed=False):
+        """Unpin a file, deleting it if its download failed"""
+        async with self.changed:
+            self.pins[name] -= 1
+            if not self.pins[name]:
+                del self.pins[name]
+            if failed and name in self.files:
+                self.drop(name)
+            self.changed.notify_all()
+
+    async def release_files(self, files):
+        """Unpin the (name, path, message) files returned by download_unit"""
+        for name in dict.fromkeys(name for name, _, _ in files):
+            await self.release(name)
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def get_spool():
+    global spool
+    if spool is None:
+        spool = Spool(capacity=options.spool_mb * MB)
+    return spool
+
+def spool_name(media):
+    """Spool file name: the file's unique ID with an extension Telegram will accept"""
+    suffix = Path(getattr(media, "file_name", None) or "").suffix
+    if not suffix:
+        suffix = mimetypes.guess_extension(getattr(media, "mime_type", None) or "image/jpeg") or ""
+    return f"{media.file_unique_id}{suffix}"
+
+async def download_parallel(client, message, path, size):
+    """Download a file as DOWNLOAD_PARTS ranges of 1 MiB chunks fetched at the same time
+
+    Files of unknown size are streamed in one piece.
+    """
+    chunks = max(1, math.ceil(size / DOWNLOAD_CHUNK))
+    per_part = math.ceil(chunks / DOWNLOAD_PARTS) if size else 0
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+    async def fetch_range(first):
+        with open(path, "r+b") as f:
+            f.seek(first * DOWNLOAD_CHUNK)
+            async for data in client.stream_media(message, offset=first, limit=per_part):
+                f.write(data)
+
+    await asyncio.gather(*(fetch_range(first) for first in range(0, chunks, per_part or chunks)))
+
+async def download_unit(client, messages):
+    """Spool the media of a unit; returns (name, path, message) for each media message"""
+    spooled = get_spool()
+    files = []
+    for message in messages:
+        if not message.media:
+            continue
+        media = getattr(message, message.media.value, None)
+        if not getattr(media, "file_unique_id", None):
+            # Link previews, polls, locations...: text messages are sent again as text
+            continue
+        files.append((spool_name(media), media.file_size or 0, message))
+    missing = set(await spooled.reserve((name, size) for name, size, _ in files))
+    try:
+        for name, size, message in files:
+            if name not in missing:
+                continue
+            started = time.monotonic()
+            await download_parallel(client, message, spooled.path / name, size)
+            spooled.downloaded(name)
+            missing.discard(name)
+            elapsed = max(time.monotonic() - started, 1e-6)
+            logger.info(f"Downloaded {name}: {size/MB:.1f} MB in {elapsed:.1f}s ({size/MB/elapsed:.2f} MB/s)")
+    except BaseException:
+        for name in dict.fromkeys(name for name, _, _ in files):
+            await spooled.release(name, failed=name in missing)
+        raise
+    return [(name, spooled.path / name, message) for name, _, message in files]
+
+async def upload_unit(client, job, messages, files):
+    """Send a unit again from spooled files, keeping texts, captions and albums"""
+    started = time.monotonic()
+    if len(messages) > 1:
+        sent = await call_api(
+            client.send_media_group, job.to_chat_id,
+            [
+                ALBUM_MEDIA[message.media.value](
+                    str(path), caption=message.caption or "", caption_entities=message.caption_entities
+                )
+                for _, path, message in files
+            ]
+        )
+    elif files:
+        _, path, message = files[0]
+        kind = message.media.value
+        media = getattr(message, kind)
+        kwargs = {kind: str(path)}
+        if kind not in ("sticker", "video_note"):
+            kwargs.update(caption=message.caption or "", caption_entities=message.caption_entities)
+        if kind in ("video", "document", "audio", "animation"):
+            kwargs["file_name"] = getattr(media, "file_name", None)
+        sent = [await call_api(getattr(client, f"send_{kind}"), job.to_chat_id, **kwargs)]
+    elif messages[0].text:
+        sent = [await call_api(
+            client.send_message, job.to_chat_id, messages[0].text, entities=messages[0].entities,
+            disable_web_page_preview=not messages[0].web_page
+        )]
+    else:
+        raise ValueError("message cannot be re-uploaded")
+    if files:
+        size = sum(path.stat().st_size for _, path, _ in files)
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Uploaded {', '.join(name for name, _, _ in files)}: {size/MB:.1f} MB in {elapsed:.1f}s "
+                    f"({size/MB/elapsed:.2f} MB/s)")
+    return sent
+
+async def download_ahead(client, units, downloaded):
+    """Spool each unit in order for the uploader; the queue is closed with None"""
+    for messages in units:
+        try:
+            files = await download_unit(client, messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            files = e
+        await downloaded.put((messages, files))
+    await downloaded.put(None)
+
+async def reupload_chunk(client, job, chunk):
+    """Re-send a chunk from a chat that restricts forwarding by downloading and uploading it
+
+    Up to REUPLOAD_AHEAD units are downloaded while earlier ones upload.
+    The scanning client does both, since file references belong to the
+    account that fetched them. Returns the number of failed IDs.
+    """
+    messages = await call_api(client.get_messages, job.from_chat_id, chunk)
+    units = [unit for unit, _ in group_prepared(messages, [None] * len(messages))]
+    downloaded = asyncio.Queue(maxsize=REUPLOAD_AHEAD)
+    downloader = asyncio.create_task(download_ahead(client, units, downloaded))
+    failed = 0
+    try:
+        item = await downloaded.get()
+        while item is not None:
+            messages, files = item
+            unit = [message.id for message in messages]
+            try:
+                if isinstance(files, Exception):
+                    raise files
+                if any(message.empty for message in messages):
+                    raise ValueError("message no longer exists")
+                sent = await upload_unit(client, job, messages, files)
+            except (PeerIdInvalid, ChannelInvalid):
+                raise
+            except Exception as e:
+                logger.warning(f"Could not re-upload {unit[0]}-{unit[-1]}: {e}")
+                ledger.record(job.from_chat_id, job.to_chat_id, unit, "failed")
+                release_fingerprints(job, unit)
+                failed += len(unit)
+            else:
+                record_sent(job, unit, [message.id for message in sent], pool.members[0])
+            finally:
+                if isinstance(files, list):
+                    await get_spool().release_files(files)
+            item = await downloaded.get()
+    except BaseException:
+        downloader.cancel()
+        await asyncio.gather(downloader, return_exceptions=True)
+        # Units downloaded ahead would otherwise stay pinned in the spool
+        while not downloaded.empty():
+            item = downloaded.get_nowait()
+            if item and isinstance(item[1], list):
+                await get_spool().release_files(item[1])
+        raise
+    await downloader
+    return failed
+
+async def send_chunk(client, job, chunk, prepared=None):
+    """Send one chunk the way its job asks for and return the number of failed IDs
+
+    Errors other than an invalid peer are recorded against the whole chunk.
+    """
+    try:
+        if prepared is not None:
+            return await copy_rewritten(client, job, chunk, prepared)
+        if job.protected:
+            return await reupload_chunk(client, job, chunk)
+        try:
+            return await forward_chunk(client, job, chunk)
+        except ChatForwardsRestricted:
+            if not options.reupload:
+                raise
+            logger.warning(f"{job.orig} restricts forwarding, downloading and re-uploading its media instead")
+            job.protected = True
+            return await reupload_chunk(client, job, chunk)
+        
+    except (PeerIdInvalid, ChannelInvalid):
+        # Every other chunk would fail the same way
+        release_fingerprints(job, chunk)
+        raise
+    except Exception as e:
+        logger.error(f"Error forwarding messages {chunk[0]}-{chunk[-1]}: {e}", exc_info=True)
+        ledger.record(job.from_chat_id, job.to_chat_id, chunk, "failed")
+        release_fingerprints(job, chunk)
+        # Brief pause before continuing
+        await asyncio.sleep(2)
+        return len(chunk)
+
+async def auto_forward(client, job, queue, total=None):
+    """Forward messages from source to destination chat with error handling and progress tracking
+
+    Units are taken from the job's queue and packed into chunks of up to
+    `batch_size` IDs per request, and every outcome is recorded in the ledger.
+    Pacing is left to the shared rate limiter.
+    """
+    current = 0
+    failed = 0
+    chunks = iter_chunks(queue, batch_size)
+    # Rewritten copies are fetched and rewritten in the worker pool ahead of the sender
+    chunks = rewrite_ahead(client, job, chunks) if job.copy and job.rewrites else without_rewrites(chunks)
+    
+    async for chunk, prepared in chunks:
+        current += len(chunk)
+        show_progress(job, current, total)
+        failed += await send_chunk(client, job, chunk, prepared)
             
-    print(f"\nTask completed! Successfully forwarded {total-failed} messages.")
+    print(f"\nTask completed! Successfully forwarded {current-failed} messages from {job.orig}.")
     if failed > 0:
         print(f"Failed to forward {failed} messages.")
 
-def countdown():
+PROGRESS_WIDTH = 30
+
+def show_progress(job, current, total=None):
+    """Redraw the progress line in place"""
+    if total:
+        done = min(current / total, 1.0)
+        bar = "#" * int(done * PROGRESS_WIDTH)
+        line = f"Forwarding {job.label}: [{bar:<{PROGRESS_WIDTH}}] {current}/{total} ({done*100:.1f}%)"
+    else:
+        line = f"Forwarding {job.label}: {current}"
+    if pool:
+        line += f" {pool.messages_per_minute():.1f} msg/min"
+    print(f"\r{line}\033[K", end="", flush=True)
+
+async def countdown():
     """Display countdown timer for restart mode"""
     time_sec = 4*3600
     while time_sec:
@@ -414,35 +2210,325 @@ def countdown():
         hours, mins = divmod(mins, 60)
         timeformat = f'{hours:02d}:{mins:02d}:{secs:02d}'
         print('Restarting in:', timeformat, end='\r')
-        time.sleep(1)
+        await asyncio.sleep(1)
         time_sec -= 1
 
-def get_full_chat():
-    """Main function to get and forward messages"""
+class OriginScans:
+    """One history scan per origin, shared by all the jobs that read it
+
+    The first of those jobs to run starts the scan and the others wait for
+    it; each then forwards its own selection through its own queue. Origins
+    read by a single job, or only by jobs whose filters Telegram can search
+    on the server, keep the regular get_ids path.
+    """
+
+    def __init__(self, client, jobs, resume):
+        self.client = client
+        self.resume = resume
+        self.jobs = {}
+        for job in jobs:
+            self.jobs.setdefault(job.from_chat_id, []).append(job)
+        self.scans = {}
+
+    def shared(self, job):
+        jobs = self.jobs.get(job.from_chat_id, ())
+        return len(jobs) > 1 and not all(search_filters(other.filter) for other in jobs)
+
+    async def units(self, job):
+        scan = self.scans.get(job.from_chat_id)
+        if scan is None:
+            scan = asyncio.ensure_future(scan_origin(self.client, self.jobs[job.from_chat_id], self.resume))
+            self.scans[job.from_chat_id] = scan
+        # A job that is cancelled while waiting must not cancel the scan of the others
+        return (await asyncio.shield(scan)).pop(job)
+
+    def cancel(self):
+        for scan in self.scans.values():
+            scan.cancel()
+
+async def run_job(client, job, resume, scans=None):
+    """Scan a job's origin and forward it, overlapping both through a bounded queue"""
+    if options.retry_failed:
+        # Only the IDs the ledger recorded as failed
+        open_checkpoint(job)
+        chat_ids = ledger.failed_ids(job.from_chat_id, job.to_chat_id)
+        if not chat_ids:
+            logger.info(f"No failed messages to retry from {job.orig}")
+            return
+        logger.info(f"Retrying {len(chat_ids)} failed messages from {job.orig}")
+        chat_ids, total = iter_ids([([message_id], None) for message_id in chat_ids]), len(chat_ids)
+    elif options.stream:
+        # Forward while the history is still being scanned
+        chat_ids, total = stream_ids(client, job, resume), None
+    else:
+        # Get message IDs to forward, from one scan shared with the jobs reading the same origin
+        if scans and scans.shared(job):
+            chat_ids = await scans.units(job)
+        else:
+            chat_ids = await get_ids(client, job, resume)
+        if not chat_ids:
+            logger.info(f"No messages to forward from {job.orig}")
+            return
+        chat_ids, total = iter_ids(chat_ids), chat_ids.message_count()
+    await forward_from(client, job, chat_ids, total)
+
+async def forward_from(client, job, chat_ids, total=None):
+    """Feed an async iterable of (unit, fingerprint) to the forwarder through a bounded queue"""
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    metrics.gauges[("queue_depth", job.label)] = queue.qsize
+    scanner = asyncio.create_task(feed_queue(job, chat_ids, queue))
+    try:
+        await auto_forward(client, job, queue, total)
+    except BaseException:
+        scanner.cancel()
+        raise
+    finally:
+        metrics.gauges.pop(("queue_depth", job.label), None)
+    await scanner
+
+async def resolve_again(client, job, e):
+    """Drop the cached chats of a job whose peer Telegram rejected and resolve them through the API"""
+    logger.warning(f"Chat of {job.orig} -> {job.to_chat_id} is no longer valid ({e}), resolving again")
+    chat_cache.invalidate(job.from_chat_id)
+    chat_cache.invalidate(job.to_chat_id)
+    await get_chats(client, job, configs.get("bot_id", "bot_id:none"))
+    await pool.prepare(job)
+
+async def run_destination(client, jobs, resume, scans=None):
+    """Run the jobs sharing one destination one after another to keep its order
+
+    If Telegram rejects a cached peer, its cache entries are dropped and the
+    job is resolved again and retried once, with a scan of its own.
+    """
+    for job in jobs:
+        try:
+            try:
+                await run_job(client, job, resume, scans)
+            except (PeerIdInvalid, ChannelInvalid) as e:
+                await resolve_again(client, job, e)
+                await run_job(client, job, resume)
+        except Exception as e:
+            logger.error(f"Error forwarding {job.orig} -> {job.to_chat_id}: {e}", exc_info=True)
+
+def register_live_handler(client, jobs):
+    """Route new origin messages that pass each job's filter and query into per-destination queues
+
+    Items are (job, unit, fingerprint) in arrival order. Album items are
+    held for ALBUM_WAIT seconds and queued together as one unit if any of
+    them matches.
+    """
+    queues = {}
+    updates = {job: queues.setdefault(job.to_chat_id, asyncio.Queue()) for job in jobs}
+    albums = {}
+
+    def flush_album(job, group_id):
+        unit, fingerprints, matched = albums.pop((job, group_id))
+        if matched:
+            updates[job].put_nowait((job, sorted(unit), unit_fingerprint(fingerprints)))
+
+    async def on_message(_, message):
+        if is_empty_message(message):
+            return
+        for job, queue in updates.items():
+            if message.chat.id != job.from_chat_id:
+                continue
+            matched = matches_query(message, job.query) and matches_filter(message, job.filter)
+            if message.media_group_id is None:
+                if matched:
+                    queue.put_nowait((job, [message.id], unit_fingerprint([fingerprint(message)])))
+                continue
+            key = (job, message.media_group_id)
+            if key not in albums:
+                albums[key] = ([], [], False)
+                asyncio.get_running_loop().call_later(ALBUM_WAIT, flush_album, job, message.media_group_id)
+            unit, fingerprints, album_matched = albums[key]
+            unit.append(message.id)
+            fingerprints.append(fingerprint(message))
+            albums[key] = (unit, fingerprints, album_matched or matched)
+
+    origins = list({job.from_chat_id for job in jobs})
+    client.add_handler(MessageHandler(on_message, filters.chat(origins)))
+    return updates
+
+async def next_live_unit(queue, wait=True, stopped=()):
+    """Take the next queued (job, unit) that is newer than its job's checkpoint and not a duplicate
+
+    Units of stopped jobs are dropped. With wait=False, returns None once
+    the queue is empty.
+    """
+    while wait or not queue.empty():
+        job, unit, digest = await queue.get()
+        if job in stopped:
+            continue
+        unit = [message_id for message_id in unit if message_id > job.last_id]
+        if unit and claim_unit(job, unit, digest):
+            return job, unit
+    return None
+
+async def forward_live(client, queue):
+    """Forward the new messages of a destination's jobs one chunk at a time, in arrival order
+
+    Consecutive units of the same job are packed into chunks of up to
+    `batch_size` IDs, like iter_chunks does for a single job. If Telegram
+    rejects a job's peer, the job is resolved again and the chunk retried
+    once; if that fails too, only that job stops listening.
+    """
+    current = {}
+    stopped = set()
+    item = await next_live_unit(queue, stopped=stopped)
+    while True:
+        job, chunk = item[0], list(item[1])
+        item = await next_live_unit(queue, False, stopped)
+        while item and item[0] is job and len(chunk) + len(item[1]) <= batch_size:
+            chunk.extend(item[1])
+            item = await next_live_unit(queue, False, stopped)
+        current[job] = current.get(job, 0) + len(chunk)
+        show_progress(job, current[job])
+        prepared = await prepare_rewrite(client, job, chunk) if job.copy and job.rewrites else None
+        try:
+            try:
+                await send_chunk(client, job, chunk, prepared)
+            except (PeerIdInvalid, ChannelInvalid) as e:
+                await resolve_again(client, job, e)
+                await send_chunk(client, job, chunk, prepared)
+        except Exception as e:
+            logger.error(f"Error forwarding {job.orig} -> {job.to_chat_id}, no longer listening: {e}", exc_info=True)
+            ledger.record(job.from_chat_id, job.to_chat_id, chunk, "failed")
+            stopped.add(job)
+            if item and item[0] is job:
+                release_fingerprints(job, item[1])
+                item = None
+        if item is None:
+            item = await next_live_unit(queue, stopped=stopped)
+
+async def run_live_destination(client, jobs, updates):
+    """Backfill each job from its checkpoint in order, then forward new messages as they arrive
+
+    Jobs sharing the destination share one update queue, so their new
+    messages go out one chunk at a time in the order they were received.
+    Updates received while backfilling wait in the queue and are dropped
+    if the backfill already covered them. A rejected peer is resolved
+    again like in run_destination, so it never stops other destinations.
+    """
+    for job in jobs:
+        try:
+            try:
+                await forward_from(client, job, stream_ids(client, job, True))
+            except (PeerIdInvalid, ChannelInvalid) as e:
+                await resolve_again(client, job, e)
+                await forward_from(client, job, stream_ids(client, job, True))
+        except Exception as e:
+            logger.error(f"Error backfilling {job.orig} -> {job.to_chat_id}: {e}", exc_info=True)
+    for job in jobs:
+        logger.info(f"Listening for new messages in {job.orig}")
+    await forward_live(client, updates[jobs[0]])
+
+async def get_full_chat(jobs, resume):
+    """Main function to get and forward messages
+
+    All jobs are scanned through one connection and its rate limiter, and
+    forwarded through the client pool. Jobs are resolved concurrently, then
+    each destination runs its jobs in order while different destinations
+    proceed in parallel. Jobs reading the same origin share one scan of it.
+    """
+    global limiter, ledger, dedup, chat_cache, pool, rewrite_pool, spool
     try:
-        # Initialize the appropriate client mode
-        if mode == "user":
-            client = ensure_connection('user')
-        else:  # bot mode
-            client = ensure_connection('bot')
+        # The 'user' or 'bot' session, still running if a previous cycle started it
+        client = await ensure_connection(mode)
             
-        with client:
+        ledger = Ledger()
+        dedup = DedupIndex(ledger)
+        chat_cache = ChatCache()
+        pool = None
+        scans = None
+        server = await metrics.serve(options.metrics_port) if options.metrics_port else None
+        writer = asyncio.create_task(metrics.write_every(options.metrics_file)) if options.metrics_file else None
+        try:
+            # Pace every API call with the rate learned for this account and mode
+            account = getattr(getattr(client, "me", None), "id", client.name)
+            limiter = RateLimiter.load(f"{account}:{mode}", 1 / delay)
+            client.set_parse_mode(ParseMode.DISABLED)
+            pool = await open_pool(client)
             # Get chat information
-            get_chats(client, configs.get("bot_id", "bot_id:none"))
-            # Get message IDs to forward
-            chat_ids = get_ids(client)
+            bot_id = configs.get("bot_id", "bot_id:none")
+            results = await asyncio.gather(
+                *(get_chats(client, job, bot_id) for job in jobs), return_exceptions=True
+            )
+            resolved = [job for job, result in zip(jobs, results) if not isinstance(result, Exception)]
+            if not resolved:
+                raise results[0]
             
-            # Forward messages
-            if chat_ids:
-                client.set_parse_mode(ParseMode.DISABLED)
-                auto_forward(client, chat_ids)
+            destinations = {}
+            for job in resolved:
+                destinations.setdefault(job.to_chat_id, []).append(job)
+                await pool.prepare(job)
+            if options.live:
+                # Register before backfilling so nothing posted meanwhile is missed
+                updates = register_live_handler(client, resolved)
+                await asyncio.gather(
+                    *(run_live_destination(client, group, updates) for group in destinations.values())
+                )
             else:
-                logger.info("No messages to forward")
+                scans = OriginScans(client, resolved, resume)
+                await asyncio.gather(
+                    *(run_destination(client, group, resume, scans) for group in destinations.values())
+                )
+            pool.save()
+        finally:
+            if scans:
+                scans.cancel()
+            if rewrite_pool:
+                rewrite_pool.shutdown()
+                rewrite_pool = None
+            if spool:
+                spool.close()
+                spool = None
+            if writer:
+                writer.cancel()
+                metrics.write(options.metrics_file)
+            if server:
+                server.close()
+            ledger.close()
     except Exception as e:
         logger.error(f"Error in get_full_chat: {e}", exc_info=True)
         raise
 
-def main():
+async def run_import(path, manifest_path):
+    """Resolve a links file through one connection and its rate limiter, see import_links"""
+    global limiter, chat_cache
+    try:
+        client = await ensure_connection(mode)
+        chat_cache = ChatCache()
+        account = getattr(getattr(client, "me", None), "id", client.name)
+        limiter = RateLimiter.load(f"{account}:{mode}", 1 / delay)
+        await import_links(client, path, manifest_path)
+        limiter.save()
+    finally:
+        await stop_clients()
+
+async def run(jobs):
+    """Run the jobs once, live or in restart cycles, all on the same started clients"""
+    try:
+        # Handle live, restart option or single run
+        if options.live:
+            logger.info("Running in live mode, forwarding new messages as they arrive")
+            await get_full_chat(jobs, True)
+        elif options.restart:
+            logger.info("Running in continuous mode with periodic restarts")
+            resume = options.resume
+            while True:
+                await get_full_chat(jobs, resume)
+                await countdown()
+                # Later cycles only fetch what was posted since the checkpoint
+                resume = True
+        else:
+            logger.info("Running in single execution mode")
+            await get_full_chat(jobs, options.resume)
+    finally:
+        await stop_clients()
+
+async def start():
+    """Log in if credentials were given, then run the command on the clients that are already started"""
     global delay, configs
     
     try:
@@ -451,12 +2537,13 @@ def main():
             "user_delay_seconds": 10.0,
             "bot_delay_seconds": 5.0,
             "skip_delay_seconds": 1.0,
-            "bot_id": "bot_id:none"
+            "bot_id": "bot_id:none",
+            "pool_sessions": []
         }
         
         # If API credentials are provided, set up the connection
         if options.api_id:
-            _, bot_id = connect_to_api(options.api_id, options.api_hash, options.bot_token)
+            _, bot_id = await connect_to_api(options.api_id, options.api_hash, options.bot_token, options.session)
             configs["bot_id"] = bot_id
         else:
             # Load configuration from file
@@ -469,62 +2556,185 @@ def main():
                     configs["bot_delay_seconds"] = float(config_data.get("bot_delay_seconds", "5.0"))
                     configs["skip_delay_seconds"] = float(config_data.get("skip_delay_seconds", "1.0"))
                     configs["bot_id"] = config_data.get("bot_id", "bot_id:none")
+                    configs["pool_sessions"] = [
+                        name.strip() for name in config_data.get("pool_sessions", "").split(",") if name.strip()
+                    ]
+                    configs["routes"] = config_data.get("routes")
+        if options.pool is not None:
+            configs["pool_sessions"] = [name.strip() for name in options.pool.split(",") if name.strip()]
 
-        # Set delay based on mode
+        # The configured delay seeds the rate limiter until a rate has been learned
         delay = configs["user_delay_seconds"] if mode == "user" else configs["bot_delay_seconds"]
-        logger.info(f"Using delay of {delay} seconds between messages")
+        logger.info(f"Using initial delay of {delay} seconds between requests")
 
-        # Handle restart option or single run
-        if options.restart:
-            logger.info("Running in continuous mode with periodic restarts")
-            while True:
-                get_full_chat()
-                countdown()
+        if options.import_links:
+            manifest = options.manifest or str(Path(options.import_links).with_suffix(".resolved.json"))
+            await run_import(options.import_links, manifest)
+            return
+
+        # -o/-d/-f/-q is a shortcut for a single job; the routes in config.ini apply when no job is given
+        if options.jobs:
+            jobs = load_jobs(options.jobs)
+        elif options.routes:
+            jobs = load_routes(options.routes)
+        elif options.orig:
+            jobs = [Job(options.orig, options.dest, options.filter, options.query,
+                        options.copy, options.caption, options.replace, options.strip_links)]
+        elif configs.get("routes"):
+            jobs = load_routes(configs["routes"])
         else:
-            logger.info("Running in single execution mode")
-            get_full_chat()
-            
+            jobs = []
+        if not jobs:
+            logger.info("No origin chat given, nothing to forward")
+            return
+        await run(jobs)
+    finally:
+        await stop_clients()
+
+def main(argv=None):
+    parse_options(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if sys.stdout.isatty():
+        os.system('clear || cls')
+    try:
+        asyncio.run(start())
     except KeyboardInterrupt:
         logger.info("Process interrupted by user")
     except Exception as e:
         logger.error(f"Error in main function: {e}", exc_info=True)
         raise
 
-# Parse command line arguments
-os.system('clear || cls')
-parser = ArgumentParser()
-parser.add_argument(
-    "-m","--mode",choices=["user", "bot"],default="user",
-    help="'user'=forward in user mode,'bot'=forward in bot mode"
-)
-parser.add_argument(
-    "-R","--restart", action=BooleanOptionalAction,
-    help="The program will restart searching for new messages on origin chat."
-)
-parser.add_argument("-o","--orig",help="Origin chat id, username, or link")
-parser.add_argument("-d","--dest",help="Destination chat id, username, or link")
-parser.add_argument("-q","--query",type=str,default="",help="Query string to filter messages")
-parser.add_argument("-r","--resume", action=BooleanOptionalAction,help="Resume task from last forwarded message")
-parser.add_argument("-l","--limit",type=int,default=0,help="Max number of messages to forward")
-parser.add_argument("-f","--filter",type=str,default=None,help="Filter messages by type (photo,text,document,etc)")
-parser.add_argument('-i','--api-id',type=int,help="Api id")
-parser.add_argument('-s','--api-hash',type=str,help="Api hash")
-parser.add_argument('-b','--bot-token',type=str,help="Token of a bot")
-options = parser.parse_args()
+def build_parser():
+    """The command line options"""
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-m","--mode",choices=["user", "bot"],default="user",
+        help="'user'=forward in user mode,'bot'=forward in bot mode"
+    )
+    parser.add_argument(
+        "-R","--restart", action=BooleanOptionalAction,
+        help="The program will restart searching for new messages on origin chat."
+    )
+    parser.add_argument(
+        "-L","--live", action=BooleanOptionalAction,
+        help="Backfill from the last forwarded message, then forward new messages as they are posted"
+    )
+    parser.add_argument("-o","--orig",help="Origin chat id, username, or link")
+    parser.add_argument("-d","--dest",help="Destination chat id, username, or link")
+    parser.add_argument(
+        "-j","--jobs",type=str,default=None,
+        help='JSON file with a list of {"orig","dest","filter","query"} jobs run concurrently'
+    )
+    parser.add_argument(
+        "--routes",type=str,default=None,
+        help="TOML or YAML file routing each origin to its destinations (default: routes in config.ini)"
+    )
+    parser.add_argument(
+        "--import-links",type=str,default=None,metavar="FILE",
+        help="Resolve a file of chat links, usernames or IDs (one per line) and write their IDs to a manifest"
+    )
+    parser.add_argument(
+        "--manifest",type=str,default=None,
+        help="Manifest written by --import-links (default: the links file with a .resolved.json suffix)"
+    )
+    parser.add_argument("-q","--query",type=str,default="",help="Query string to filter messages")
+    parser.add_argument("-r","--resume", action=BooleanOptionalAction,help="Resume task from last forwarded message")
+    parser.add_argument(
+        "-S","--stream", action=BooleanOptionalAction,
+        help="Start forwarding while the origin history is still being scanned (oldest first)"
+    )
+    parser.add_argument(
+        "--retry-failed", action=BooleanOptionalAction,
+        help="Only forward the messages recorded as failed in the ledger"
+    )
+    parser.add_argument(
+        "--dedup", action=BooleanOptionalAction, default=True,
+        help="Skip messages whose content was already sent to the destination (default: on)"
+    )
+    parser.add_argument(
+        "-C","--copy", action=BooleanOptionalAction,
+        help="Copy the messages instead of forwarding them, without the forward header"
+    )
+    parser.add_argument(
+        "--caption",type=str,default=None,
+        help='Caption template for copies, {text} is replaced by the original text (e.g. "{text}\\n\\nvia @channel"); '
+             'formatting is kept, except in albums and with --replace or --strip-links'
+    )
+    parser.add_argument(
+        "--replace",action="append",default=[],metavar="PATTERN=>REPLACEMENT",
+        help="Regex substitution applied to the text of copies (may be given several times)"
+    )
+    parser.add_argument(
+        "--strip-links", action=BooleanOptionalAction,
+        help="Remove links from the text of copies"
+    )
+    parser.add_argument(
+        "--copy-workers",type=int,default=None,
+        help="Processes rewriting the texts of copies (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--reupload", action=BooleanOptionalAction, default=True,
+        help="Download and re-upload messages from chats that restrict forwarding (default: on)"
+    )
+    parser.add_argument(
+        "--spool-mb",type=int,default=2048,
+        help="Disk space in MB for media waiting to be re-uploaded"
+    )
+    parser.add_argument(
+        "--metrics-port",type=int,default=None,
+        help="Serve Prometheus metrics (request latency, message counts, queue depth) on this port"
+    )
+    parser.add_argument(
+        "--metrics-file",type=str,default=None,
+        help=f"Write a JSON snapshot of the metrics to this file every {METRICS_INTERVAL:.0f} seconds"
+    )
+    parser.add_argument(
+        "--scan-shards",type=int,default=4,
+        help="History ranges scanned at the same time when collecting messages (1 = a single iterator)"
+    )
+    parser.add_argument("-l","--limit",type=int,default=0,help="Max number of messages to forward")
+    parser.add_argument(
+        "-B","--batch-size",type=int,default=MAX_FORWARD_BATCH,
+        help=f"Number of messages forwarded per request (1-{MAX_FORWARD_BATCH})"
+    )
+    parser.add_argument("-f","--filter",type=str,default=None,help="Filter messages by type (photo,text,document,etc)")
+    parser.add_argument('-i','--api-id',type=int,help="Api id")
+    parser.add_argument('-s','--api-hash',type=str,help="Api hash")
+    parser.add_argument('-b','--bot-token',type=str,help="Token of a bot, or several comma separated tokens")
+    parser.add_argument(
+        '--session',type=str,default='user',
+        help="Session name to log in with --api-id; names other than 'user' join the client pool"
+    )
+    parser.add_argument(
+        "-P","--pool",type=str,default=None,
+        help="Comma separated session names that share the forwarding (default: pool_sessions in config.ini)"
+    )
+    return parser
+
+def parse_options(argv=None):
+    """Parse a command line into the module options and the globals derived from them"""
+    global options, mode, limit, batch_size
+    options = build_parser().parse_args(argv)
+    mode = options.mode
+    limit = options.limit
+    batch_size = max(1, min(options.batch_size, MAX_FORWARD_BATCH))
+    return options
 
 # Initialize global variables
 configs = {}
-chats = {}
-CACHE_FILE = None
 delay = 10.0  # Default delay if not set
-
-from_chat = options.orig
-to_chat = options.dest
-mode = options.mode
-query = options.query
-limit = options.limit
-filter = options.filter
-filter = filter.split(",") if filter else None
+limiter = None
+ledger = None
+dedup = None
+chat_cache = None
+pool = None
+rewrite_pool = None
+spool = None
+metrics = Metrics()
+# Clients started by ensure_connection, by session name
+clients = {}
+# The defaults until main() parses the real command line
+parse_options([])
 
 if __name__=="__main__":
     main()
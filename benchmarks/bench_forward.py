@@ -0,0 +1,428 @@
+"""Offline benchmark for auto_forward_messages with a fake Telegram client
+
+Every scenario runs in its own process against a synthetic origin history
+and reports messages/second, scan time, peak RSS and checkpoint I/O, so
+no Telegram account or real rate limit is involved:
+
+    python benchmarks/bench_forward.py --messages 100000 --latency 0.005
+    python benchmarks/bench_forward.py --scenario forward --flood-rate 0.01 --json
+
+The fake client answers get_chat, get_chat_history, get_chat_history_count,
+search_messages, forward_messages, create_channel and promote_chat_member
+after --latency seconds, and injects FloodWait and MessageIdInvalid.
+History is served through Pyrogram's own get_chat_history paging loop,
+with only its GetHistory request (get_chunk) replaced by the fake.
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+import subprocess
+import tempfile
+import asyncio
+import random
+import json
+import logging
+import time
+import sys
+import os
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from pyrogram.enums import MessageMediaType, MessagesFilter
+from pyrogram.errors import FloodWait, MessageIdInvalid
+from pyrogram import raw
+from pyrogram.methods.messages import get_chat_history as pyrogram_history
+
+async def get_chunk(*, client, chat_id, limit=0, offset=0, from_message_id=0, from_date=None):
+    """Stand-in for Pyrogram's single GetHistory request, answered by the fake client"""
+    return await client.get_history(limit, offset, from_message_id)
+
+pyrogram_history.get_chunk = get_chunk
+
+ORIGIN_ID = -1001000000001
+SCENARIOS = ("filter_history", "filter_search", "get_ids", "forward", "stream", "backfill")
+PAGE = 100
+# Messages past the checkpoint in the backfill scenario, less than a page
+BACKFILL = 10
+
+class FakeMedia:
+    __slots__ = ("file_unique_id", "file_size", "file_name", "mime_type")
+
+    def __init__(self, message_id, file_name=None):
+        self.file_unique_id = f"file{message_id}"
+        self.file_size = 1024 * (message_id % 500 + 1)
+        self.file_name = file_name
+        self.mime_type = "application/pdf" if file_name else "image/jpeg"
+
+class FakeMessage:
+    """Just the attributes the script reads from a pyrogram Message"""
+    __slots__ = (
+        "id", "chat", "empty", "service", "dice", "location", "poll", "media", "text", "caption",
+        "media_group_id", "entities", "caption_entities", "photo", "document"
+    )
+
+    def __init__(self, message_id, chat):
+        self.id = message_id
+        self.chat = chat
+        self.empty = False
+        self.service = self.dice = self.location = self.poll = None
+        self.entities = self.caption_entities = None
+        self.media = self.text = self.caption = self.media_group_id = None
+        self.photo = self.document = None
+        topic = "python" if message_id % 17 == 0 else "news"
+        if message_id % 25 in (1, 2, 3):
+            # Albums of three photos
+            self.media = MessageMediaType.PHOTO
+            self.photo = FakeMedia(message_id)
+            self.media_group_id = f"album{message_id // 25}"
+            self.caption = f"album {message_id // 25} about {topic}" if message_id % 25 == 1 else None
+        elif message_id % 10 == 0:
+            self.media = MessageMediaType.PHOTO
+            self.photo = FakeMedia(message_id)
+            self.caption = f"photo {message_id} about {topic}"
+        elif message_id % 13 == 0:
+            self.media = MessageMediaType.DOCUMENT
+            self.document = FakeMedia(message_id, f"{topic}-{message_id}.pdf")
+        else:
+            self.text = f"message {message_id} about {topic}"
+
+class FakeChat:
+    def __init__(self, chat_id, title):
+        self.id = chat_id
+        self.title = title
+
+class FakeUser:
+    id = 1
+    is_bot = False
+
+class FakeStorage:
+    def __init__(self):
+        self.peers = {}
+
+    async def get_peer_by_id(self, peer_id):
+        if peer_id not in self.peers:
+            raise KeyError(peer_id)
+        return self.peers[peer_id]
+
+    async def update_peers(self, peers):
+        for peer in peers:
+            self.peers[peer[0]] = peer
+
+class FakeClient:
+    """Stand-in for pyrogram.Client serving a synthetic history
+
+    Message IDs run from 1 to `messages`, with every `gap`th one deleted.
+    """
+
+    name = "bench"
+
+    def __init__(self, messages, latency=0.0, flood_rate=0.0, flood_seconds=1, invalid_rate=0.0, gap=97, seed=1):
+        self.messages = messages
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.gap = gap
+        self.random = random.Random(seed)
+        self.invalid = {
+            message_id for message_id in range(1, messages + 1) if self.random.random() < invalid_rate
+        }
+        self.me = FakeUser()
+        self.storage = FakeStorage()
+        self.chat = FakeChat(ORIGIN_ID, "origin")
+        self.next_chat_id = ORIGIN_ID - 1
+        self.next_message_id = 0
+        self.calls = {}
+        self.searches = {}
+
+    def exists(self, message_id):
+        return 1 <= message_id <= self.messages and message_id % self.gap != 0
+
+    def message(self, message_id):
+        return FakeMessage(message_id, self.chat)
+
+    async def request(self, method):
+        """Count the call, wait the simulated latency and maybe raise an injected FloodWait"""
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            raise FloodWait(value=self.flood_seconds)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def set_parse_mode(self, parse_mode):
+        pass
+
+    async def resolve_peer(self, peer_id):
+        return raw.types.InputPeerChannel(channel_id=int(str(peer_id).replace("-100", "", 1)), access_hash=1)
+
+    async def get_chat(self, chat_id):
+        await self.request("get_chat")
+        return FakeChat(int(chat_id), f"chat {chat_id}")
+
+    async def create_channel(self, title):
+        await self.request("create_channel")
+        chat = FakeChat(self.next_chat_id, title)
+        self.next_chat_id -= 1
+        return chat
+
+    async def promote_chat_member(self, chat_id, user_id, privileges=None):
+        await self.request("promote_chat_member")
+        return True
+
+    async def get_chat_history_count(self, chat_id):
+        await self.request("get_chat_history_count")
+        return self.messages - self.messages // self.gap
+
+    async def get_history(self, limit, offset, offset_id):
+        """One GetHistory request, with Telegram's window rules
+
+        The window starts below offset_id (or at the newest message), moved
+        `offset` messages older, or newer if negative, and spans `limit`
+        messages newest first. The part of it past the newest message is
+        empty rather than shifted back, so such a window comes back short.
+        """
+        await self.request("get_chat_history")
+        limit = min(limit, PAGE)
+        bound = min(offset_id, self.messages + 1) if offset_id else self.messages + 1
+        for _ in range(max(offset, 0)):
+            bound -= 1
+            while bound >= 1 and not self.exists(bound):
+                bound -= 1
+        for _ in range(max(-offset, 0)):
+            while bound <= self.messages and not self.exists(bound):
+                bound += 1
+            if bound > self.messages:
+                limit -= 1
+            else:
+                bound += 1
+        messages = []
+        message_id = bound - 1
+        while message_id >= 1 and len(messages) < limit:
+            if self.exists(message_id):
+                messages.append(self.message(message_id))
+            message_id -= 1
+        return messages
+
+    # Pyrogram's paging loop, so its re-requests on short pages are part of the benchmark
+    get_chat_history = pyrogram_history.GetChatHistory.get_chat_history
+
+    def matches(self, message, query, filter):
+        if filter == MessagesFilter.PHOTO and message.media != MessageMediaType.PHOTO:
+            return False
+        if filter == MessagesFilter.DOCUMENT and message.media != MessageMediaType.DOCUMENT:
+            return False
+        if filter not in (None, MessagesFilter.EMPTY, MessagesFilter.PHOTO, MessagesFilter.DOCUMENT):
+            return False
+        text = message.text or message.caption or getattr(message.document, "file_name", None) or ""
+        return query.lower() in text.lower()
+
+    def search_results(self, query, filter):
+        """IDs matching a search, newest first, computed once per search"""
+        key = (query, filter)
+        if key not in self.searches:
+            self.searches[key] = [
+                message_id for message_id in range(self.messages, 0, -1)
+                if self.exists(message_id) and self.matches(self.message(message_id), query, filter)
+            ]
+        return self.searches[key]
+
+    async def search_messages(self, chat_id, query="", offset=0, filter=None, limit=0):
+        results = self.search_results(query, filter)
+        end = min(len(results), offset + limit) if limit else len(results)
+        for start in range(offset, end, PAGE):
+            await self.request("search_messages")
+            for message_id in results[start:min(start + PAGE, end)]:
+                yield self.message(message_id)
+
+    async def search_messages_count(self, chat_id, query="", filter=None):
+        await self.request("search_messages_count")
+        return sum(
+            1 for message_id in range(1, self.messages + 1)
+            if self.exists(message_id) and self.matches(self.message(message_id), query, filter)
+        )
+
+    async def get_media_group(self, chat_id, message_id):
+        await self.request("get_media_group")
+        first = message_id - (message_id % 25 - 1)
+        return [self.message(i) for i in range(first, first + 3) if self.exists(i)]
+
+    async def forward_messages(self, chat_id, from_chat_id, message_ids):
+        await self.request("forward_messages")
+        if self.invalid.intersection(message_ids):
+            raise MessageIdInvalid()
+        sent = []
+        for _ in message_ids:
+            self.next_message_id += 1
+            sent.append(FakeChat(self.next_message_id, None))
+        return sent
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def write_bytes():
+    """Bytes this process wrote to storage, where the OS reports it"""
+    try:
+        with open("/proc/self/io") as io:
+            for line in io:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+async def run_scenario(afm, name, args):
+    """Run one scenario in this process and return its measurements"""
+    client = FakeClient(
+        args.messages, args.latency, args.flood_rate, args.flood_seconds, args.invalid_rate, seed=args.seed
+    )
+    afm.MAX_RATE = max(afm.MAX_RATE, args.rate)
+    afm.limiter = afm.RateLimiter("bench", args.rate)
+    afm.ledger = afm.Ledger()
+    afm.dedup = afm.DedupIndex(afm.ledger)
+    afm.chat_cache = afm.ChatCache()
+    afm.pool = afm.ClientPool([afm.PoolMember(client, afm.limiter)])
+    afm.batch_size = args.batch_size
+    afm.limit = 0
+    afm.options.dedup = args.dedup
+    afm.options.scan_shards = args.scan_shards
+
+    job = afm.Job(str(ORIGIN_ID), None, args.filter or None, args.query)
+    if name == "filter_history" and not args.filter:
+        job.filter = ["text"]
+    elif name == "filter_search" and not args.filter:
+        job.filter = ["photo"]
+    await afm.get_chats(client, job, "bot_id:none")
+    await afm.pool.prepare(job)
+    if name == "backfill":
+        # A live start, with only the newest BACKFILL messages past the checkpoint
+        afm.ledger.record(job.from_chat_id, job.to_chat_id, [args.messages - BACKFILL], "forwarded")
+    changes = afm.ledger.db.total_changes
+    written = write_bytes()
+
+    started = time.perf_counter()
+    scan_seconds = None
+    if name in ("filter_history", "filter_search"):
+        units = await afm.filter_messages(client, job)
+        scan_seconds = time.perf_counter() - started
+        messages = sum(len(unit) for unit, _ in units)
+    elif name == "get_ids":
+        units = await afm.get_ids(client, job, False)
+        scan_seconds = time.perf_counter() - started
+        messages = sum(len(unit) for unit, _ in units)
+    elif name == "forward":
+        units = await afm.get_ids(client, job, False)
+        scan_seconds = time.perf_counter() - started
+        messages = sum(len(unit) for unit, _ in units)
+        await afm.forward_from(client, job, afm.iter_ids(units), messages)
+    else:
+        # Scanning overlaps forwarding, so only the total is meaningful
+        counted = []
+
+        async def counting(units):
+            async for unit, digest in units:
+                counted.extend(unit)
+                yield unit, digest
+
+        await afm.forward_from(client, job, counting(afm.stream_ids(client, job, name == "backfill")))
+        messages = len(counted)
+        if len(set(counted)) != messages:
+            raise RuntimeError(f"Stream yielded {messages - len(set(counted))} duplicate message IDs")
+    seconds = time.perf_counter() - started
+    afm.ledger.commit()
+
+    ledger_rows = afm.ledger.db.total_changes - changes
+    ledger_bytes = sum(path.stat().st_size for path in Path(".").glob(f"{afm.LEDGER_FILE}*"))
+    written_after = write_bytes()
+    afm.ledger.close()
+    return {
+        "scenario": name,
+        "history": args.messages,
+        "messages": messages,
+        "seconds": round(seconds, 3),
+        "messages_per_second": round(messages / seconds, 1) if seconds else None,
+        "scan_seconds": round(scan_seconds, 3) if scan_seconds is not None else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1) if resource else None,
+        "ledger_rows_written": ledger_rows,
+        "ledger_bytes": ledger_bytes,
+        "write_bytes": written_after - written if written is not None else None,
+        "api_calls": dict(sorted(client.calls.items())),
+        "failed": afm.metrics.counters.get("messages_failed", 0),
+        "flood_wait_seconds": afm.metrics.counters.get("flood_wait_seconds", 0),
+    }
+
+def run_here(args):
+    """Import the script inside a scratch directory and run one scenario"""
+    os.chdir(tempfile.mkdtemp(prefix="afm-bench-"))
+    import auto_forward_messages as afm
+    afm.import_pyrogram()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    return asyncio.run(run_scenario(afm, args.scenario, args))
+
+def run_isolated(name, argv):
+    """Run a scenario in a child process so its peak RSS is its own"""
+    result = subprocess.run(
+        [sys.executable, __file__, *argv, "--scenario", name, "--json"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    raise RuntimeError(f"Scenario {name} exited with code {result.returncode}")
+
+def print_table(results):
+    columns = [
+        ("scenario", "scenario"), ("messages", "messages"), ("seconds", "total s"),
+        ("messages_per_second", "msgs/s"), ("scan_seconds", "scan s"), ("peak_rss_mb", "peak RSS MB"),
+        ("ledger_rows_written", "ledger rows"), ("ledger_bytes", "ledger bytes"), ("write_bytes", "written bytes"), ("failed", "failed"),
+    ]
+    rows = [[str(result.get(key) if result.get(key) is not None else "-") for key, _ in columns] for result in results]
+    widths = [max(len(title), *(len(row[i]) for row in rows)) for i, (_, title) in enumerate(columns)]
+    print("  ".join(title.ljust(width) for (_, title), width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+def main():
+    parser = ArgumentParser(description="Benchmark auto_forward_messages against a fake Telegram client")
+    parser.add_argument("--scenario", choices=SCENARIOS, help="Run only this scenario, in this process")
+    parser.add_argument("--messages", type=int, default=10000, help="Size of the synthetic history (10k-1M)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each fake API request takes")
+    parser.add_argument("--rate", type=float, default=1e9, help="Requests/second allowed by the rate limiter")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Probability of a FloodWait per request")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="Length of the injected FloodWaits")
+    parser.add_argument("--invalid-rate", type=float, default=0.0, help="Fraction of message IDs that are invalid")
+    parser.add_argument("--batch-size", type=int, default=100, help="Messages per forward request")
+    parser.add_argument("--filter", type=str, default=None, help="--filter for every scenario")
+    parser.add_argument("--query", type=str, default="", help="--query for every scenario")
+    parser.add_argument("--dedup", action="store_true", help="Check fingerprints while forwarding")
+    parser.add_argument("--scan-shards", type=int, default=4, help="--scan-shards for every scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", type=str, default="WARNING")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per scenario")
+    args, _ = parser.parse_known_args()
+
+    if args.scenario:
+        results = [run_here(args)]
+    else:
+        argv = [arg for arg in sys.argv[1:] if arg != "--json"]
+        results = [run_isolated(name, argv) for name in SCENARIOS]
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        print_table(results)
+
+if __name__ == "__main__":
+    main()